@@ -2,6 +2,7 @@ import os
 from pathlib import Path
 from decouple import config
 from datetime import timedelta
+from celery.schedules import crontab
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
@@ -81,6 +82,9 @@ DATABASES = {
         'PASSWORD': config('DB_PASSWORD', default=''),
         'HOST': config('DB_HOST', default='localhost'),
         'PORT': config('DB_PORT', default='5432'),
+        # Keep connections open across requests instead of reconnecting each time
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=600, cast=int),
+        'CONN_HEALTH_CHECKS': True,
     }
 }
 
@@ -288,6 +292,27 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
+# M-Pesa callbacks get their own queue so a backlog of batch jobs cannot delay them
+CELERY_TASK_ROUTES = {
+    'payments.tasks.process_mpesa_callback': {'queue': 'webhooks'},
+}
+CELERY_BEAT_SCHEDULE = {
+    # Apply M-Pesa callbacks whose own task ran out of retries
+    'process-pending-webhooks': {
+        'task': 'payments.tasks.process_pending_webhooks',
+        'schedule': crontab(minute='*'),
+    },
+    # Re-roll the last 30 days of payments; revenue analytics reads these rows
+    'generate-daily-payment-analytics': {
+        'task': 'payments.tasks.generate_daily_payment_analytics',
+        'schedule': crontab(hour=0, minute=30),
+    },
+    # Compress processed webhook payloads older than WEBHOOK_ARCHIVE_DAYS
+    'archive-processed-webhooks': {
+        'task': 'payments.tasks.archive_processed_webhooks',
+        'schedule': crontab(hour=1, minute=0),
+    },
+}
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = config('EMAIL_HOST', default='smtp.sendgrid.net')
@@ -307,6 +332,7 @@ MPESA_CONSUMER_SECRET = config('MPESA_CONSUMER_SECRET', default='')
 MPESA_SHORTCODE = config('MPESA_SHORTCODE', default='174379')
 MPESA_PASSKEY = config('MPESA_PASSKEY', default='')
 MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='')
+MPESA_RATE_LIMIT = config('MPESA_RATE_LIMIT', default=10, cast=int)
 
 WEB3_PROVIDER_URL = config('WEB3_PROVIDER_URL', default='')
 BLOCKCHAIN_PRIVATE_KEY = config('PRIVATE_KEY', default='')
@@ -365,6 +391,11 @@ LOGGING = {
             'level': config('LOG_LEVEL', default='INFO'),
             'propagate': False,
         },
+        'payments': {
+            'handlers': ['console', 'file'],
+            'level': config('PAYMENTS_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
     },
 }
 
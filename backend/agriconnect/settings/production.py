@@ -13,8 +13,12 @@ DATABASES = {
         'HOST': config('DB_HOST'),
         'PORT': config('DB_PORT'),
         'OPTIONS': {
-            'sslmode': 'require',
+            'sslmode': config('DB_SSLMODE', default='require'),
         },
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=600, cast=int),
+        'CONN_HEALTH_CHECKS': True,
+        # PgBouncer transaction pooling cannot keep server-side cursors open
+        'DISABLE_SERVER_SIDE_CURSORS': True,
     }
 }
 
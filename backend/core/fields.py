@@ -0,0 +1,19 @@
+import json
+import orjson
+
+
+class OrjsonEncoder(json.JSONEncoder):
+    """
+    JSONField encoder backed by orjson. Django calls ``json.dumps(value,
+    cls=encoder)``, which hands the whole value to ``encode``
+    """
+
+    def encode(self, o):
+        return orjson.dumps(o, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class OrjsonDecoder(json.JSONDecoder):
+    """JSONField decoder backed by orjson"""
+
+    def decode(self, s, *args, **kwargs):
+        return orjson.loads(s)
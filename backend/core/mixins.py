@@ -0,0 +1,79 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+
+def _relation_paths(model, serializer):
+    """
+    Walk a serializer's fields and return the (select_related, prefetch_related)
+    lookups needed to render it for instances of ``model``
+    """
+    select, prefetch = set(), []
+
+    for field in serializer.fields.values():
+        if field.write_only or field.source == '*':
+            continue
+
+        is_many = isinstance(field, serializers.ListSerializer)
+        nested = field.child if is_many else field
+        source_attrs = field.source.split('.')
+        if isinstance(field, serializers.RelatedField) and field.use_pk_only_optimization():
+            # Primary key fields read the local FK column, not the related row
+            source_attrs = source_attrs[:-1]
+
+        current_model, path = model, []
+        for index, attr in enumerate(source_attrs):
+            try:
+                model_field = current_model._meta.get_field(attr)
+            except FieldDoesNotExist:
+                break
+            if not model_field.is_relation:
+                break
+
+            path.append(attr)
+            related_model = model_field.related_model
+            is_last = index == len(source_attrs) - 1
+
+            if model_field.many_to_many or model_field.one_to_many:
+                # Nested many relations become a Prefetch whose queryset
+                # carries the nested serializer's own joins
+                if is_last and isinstance(nested, serializers.BaseSerializer):
+                    child_select, child_prefetch = _relation_paths(related_model, nested)
+                    queryset = related_model._default_manager.select_related(
+                        *child_select
+                    ).prefetch_related(*child_prefetch)
+                    prefetch.append(Prefetch('__'.join(path), queryset=queryset))
+                else:
+                    prefetch.append('__'.join(path))
+                break
+
+            select.add('__'.join(path))
+            if is_last and isinstance(nested, serializers.BaseSerializer):
+                child_select, child_prefetch = _relation_paths(related_model, nested)
+                prefix = '__'.join(path)
+                select.update(f'{prefix}__{lookup}' for lookup in child_select)
+                for lookup in child_prefetch:
+                    if isinstance(lookup, Prefetch):
+                        lookup.add_prefix(prefix)
+                        prefetch.append(lookup)
+                    else:
+                        prefetch.append(f'{prefix}__{lookup}')
+            current_model = related_model
+
+    return sorted(select), prefetch
+
+
+class AutoPrefetchViewSetMixin:
+    """
+    Derive select_related/prefetch_related from the view's serializer so
+    nested fields are loaded in the list query rather than per row
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        select, prefetch = _relation_paths(queryset.model, self.get_serializer())
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
@@ -1,5 +1,7 @@
 import string
 import random
+import secrets
+import time
 from typing import Any, Dict
 from django.core.mail import send_mail
 from django.conf import settings
@@ -14,6 +16,21 @@ def generate_order_id() -> str:
 def generate_transaction_id() -> str:
     return f"TXN{generate_random_string(10).upper()}"
 
+# Crockford base32, as used by ULIDs
+ULID_ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+def generate_ulid() -> str:
+    """
+    26-character ULID: a 48-bit millisecond timestamp followed by 80 random
+    bits, so IDs sort by creation time and do not realistically collide
+    """
+    value = (int(time.time() * 1000) << 80) | secrets.randbits(80)
+    chars = []
+    for _ in range(26):
+        value, index = divmod(value, 32)
+        chars.append(ULID_ALPHABET[index])
+    return ''.join(reversed(chars))
+
 def send_notification_email(to_email: str, subject: str, message: str) -> bool:
     try:
         send_mail(
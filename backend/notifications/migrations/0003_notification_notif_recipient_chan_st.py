@@ -0,0 +1,20 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0002_initial"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="notification",
+            index=models.Index(
+                fields=["recipient", "channel", "status"],
+                name="notif_recipient_chan_st",
+            ),
+        ),
+    ]
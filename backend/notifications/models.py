@@ -77,6 +77,7 @@ class Notification(BaseModel):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['recipient', 'status']),
+            models.Index(fields=['recipient', 'channel', 'status'], name='notif_recipient_chan_st'),
             models.Index(fields=['channel', 'status']),
             models.Index(fields=['created_at']),
         ]
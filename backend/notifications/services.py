@@ -1,5 +1,6 @@
 import logging
 import requests
+from functools import lru_cache
 from typing import Dict, List, Optional
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -17,6 +18,12 @@ User = get_user_model()
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=256)
+def _compile_template(source: str) -> Template:
+    """Parse a template string once and reuse the compiled template"""
+    return Template(source)
+
+
 class NotificationService:
     """Main notification service for sending various types of notifications"""
 
@@ -25,7 +32,8 @@ class NotificationService:
         user: User,
         notification_type: str,
         context_data: Dict = None,
-        channels: List[str] = None
+        channels: List[str] = None,
+        templates: Optional[Dict[str, NotificationTemplate]] = None
     ) -> List[Notification]:
         """
         Send notification to user across specified channels
@@ -35,6 +43,8 @@ class NotificationService:
             notification_type: Type of notification (from NotificationTemplate.NOTIFICATION_TYPES)
             context_data: Data to populate template variables
             channels: List of channels to send to. If None, sends to all active channels
+            templates: Templates already resolved by get_templates(). Pass this when
+                sending to many users so the lookup runs once instead of per user
 
         Returns:
             List of created Notification objects
@@ -43,20 +53,15 @@ class NotificationService:
             context_data = {}
 
         # Get user notification settings
-        settings_obj, _ = UserNotificationSettings.objects.get_or_create(user=user)
+        settings_obj = NotificationService.get_user_settings(user)
 
         # Get templates for the notification type
-        templates = NotificationTemplate.objects.filter(
-            notification_type=notification_type,
-            is_active=True
-        )
-
-        if channels:
-            templates = templates.filter(channel__in=channels)
+        if templates is None:
+            templates = NotificationService.get_templates(notification_type, channels)
 
         notifications = []
 
-        for template in templates:
+        for template in templates.values():
             # Check if user has enabled this channel and type
             if not NotificationService._should_send_notification(settings_obj, template):
                 continue
@@ -82,6 +87,36 @@ class NotificationService:
 
         return notifications
 
+    @staticmethod
+    def get_templates(notification_type: str, channels: List[str] = None) -> Dict[str, NotificationTemplate]:
+        """Return active templates for a notification type keyed by channel"""
+        templates = NotificationTemplate.objects.filter(
+            notification_type=notification_type,
+            is_active=True
+        )
+
+        if channels:
+            templates = templates.filter(channel__in=channels)
+
+        return {template.channel: template for template in templates}
+
+    @staticmethod
+    def get_user_settings(user: User) -> UserNotificationSettings:
+        """
+        Return the user's notification settings
+
+        Settings are created by a post_save signal when the user registers, so
+        the reverse accessor (cached on the user instance) normally resolves
+        without a write. Users created before the signal existed fall back to
+        get_or_create.
+        """
+        try:
+            return user.notification_settings
+        except UserNotificationSettings.DoesNotExist:
+            settings_obj, _ = UserNotificationSettings.objects.get_or_create(user=user)
+            user.notification_settings = settings_obj
+            return settings_obj
+
     @staticmethod
     def _should_send_notification(settings: UserNotificationSettings, template: NotificationTemplate) -> bool:
         """Check if notification should be sent based on user preferences"""
@@ -124,10 +159,10 @@ class NotificationService:
 
         subject = ""
         if template.subject_template:
-            subject_template = Template(template.subject_template)
+            subject_template = _compile_template(template.subject_template)
             subject = subject_template.render(context)
 
-        message_template = Template(template.message_template)
+        message_template = _compile_template(template.message_template)
         message = message_template.render(context)
 
         return subject, message
@@ -0,0 +1,14 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .models import UserNotificationSettings
+
+User = get_user_model()
+
+
+@receiver(post_save, sender=User)
+def create_user_notification_settings(sender, instance, created, **kwargs):
+    """Create default notification settings when a user is registered"""
+    if created:
+        UserNotificationSettings.objects.get_or_create(user=instance)
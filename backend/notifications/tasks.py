@@ -0,0 +1,40 @@
+from celery import shared_task
+from django.contrib.auth import get_user_model
+import logging
+
+from .services import NotificationService
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+
+@shared_task
+def send_bulk_chunk(user_ids, notification_type, context_data=None, channels=None):
+    """
+    Send a notification to one chunk of a bulk audience
+    Dispatched in parallel by NotificationViewSet.send_bulk
+    """
+    try:
+        users = User.objects.filter(id__in=user_ids).only(
+            'id', 'email', 'phone_number', 'role'
+        )
+        templates = NotificationService.get_templates(notification_type, channels)
+
+        notification_count = 0
+        for user in users:
+            notifications = NotificationService.send_notification(
+                user=user,
+                notification_type=notification_type,
+                context_data=context_data or {},
+                channels=channels,
+                templates=templates
+            )
+            notification_count += len(notifications)
+
+        logger.info(f"Bulk chunk sent {notification_count} notifications to {len(user_ids)} users")
+        return {'user_count': len(user_ids), 'notification_count': notification_count}
+
+    except Exception as e:
+        logger.error(f"Error in send_bulk_chunk task: {e}")
+        return {'error': str(e)}
@@ -1,3 +1,6 @@
+from itertools import islice
+
+from celery import group
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
@@ -20,9 +23,22 @@ from .serializers import (
     MarkAsReadSerializer
 )
 from .services import NotificationService
+from .tasks import send_bulk_chunk
 
 User = get_user_model()
 
+# Users handled by each send_bulk_chunk task
+BULK_CHUNK_SIZE = 500
+
+# Bulk notification audiences, keyed by BulkNotificationSerializer.recipient_type
+RECIPIENT_FILTERS = {
+    'ALL_USERS': Q(is_active=True),
+    'FARMERS': Q(role='farmer', is_active=True),
+    'BUYERS': Q(role='buyer', is_active=True),
+    'TRANSPORTERS': Q(role='transporter', is_active=True),
+    'COOPERATIVES': Q(role='cooperative', is_active=True),
+}
+
 
 class NotificationTemplateViewSet(viewsets.ModelViewSet):
     """ViewSet for managing notification templates"""
@@ -97,6 +113,8 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
         channels = serializer.validated_data.get('channels', None)
         context_data = serializer.validated_data.get('context_data', {})
 
+        templates = NotificationService.get_templates(notification_type, channels)
+
         sent_notifications = []
         for user_id in recipient_ids:
             try:
@@ -105,7 +123,8 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
                     user=user,
                     notification_type=notification_type,
                     context_data=context_data,
-                    channels=channels
+                    channels=channels,
+                    templates=templates
                 )
                 sent_notifications.extend(notifications)
             except User.DoesNotExist:
@@ -133,35 +152,26 @@ class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
         channels = serializer.validated_data.get('channels', None)
         context_data = serializer.validated_data.get('context_data', {})
 
-        # Get users based on recipient type
-        if recipient_type == 'ALL_USERS':
-            users = User.objects.filter(is_active=True)
-        elif recipient_type == 'FARMERS':
-            users = User.objects.filter(role='FARMER', is_active=True)
-        elif recipient_type == 'BUYERS':
-            users = User.objects.filter(role='BUYER', is_active=True)
-        elif recipient_type == 'TRANSPORTERS':
-            users = User.objects.filter(role='TRANSPORTER', is_active=True)
-        elif recipient_type == 'COOPERATIVES':
-            users = User.objects.filter(role='COOPERATIVE', is_active=True)
-        else:
-            users = User.objects.none()
-
-        sent_notifications = []
-        for user in users:
-            notifications = NotificationService.send_notification(
-                user=user,
-                notification_type=notification_type,
-                context_data=context_data,
-                channels=channels
-            )
-            sent_notifications.extend(notifications)
+        q = RECIPIENT_FILTERS.get(recipient_type)
+        users = User.objects.filter(q) if q is not None else User.objects.none()
+
+        # Fan the audience out to Celery in fixed-size chunks so the request
+        # returns immediately regardless of how many users are targeted
+        user_ids = [str(pk) for pk in users.values_list('id', flat=True)]
+        ids = iter(user_ids)
+        chunks = iter(lambda: list(islice(ids, BULK_CHUNK_SIZE)), [])
+        signatures = [
+            send_bulk_chunk.s(chunk, notification_type, context_data, channels)
+            for chunk in chunks
+        ]
+        if signatures:
+            group(signatures).apply_async()
 
         return Response({
-            'message': f'Sent notifications to {users.count()} users',
-            'user_count': users.count(),
-            'notification_count': len(sent_notifications)
-        })
+            'message': f'Queued notifications for {len(user_ids)} users',
+            'queued_user_count': len(user_ids),
+            'task_count': len(signatures)
+        }, status=status.HTTP_202_ACCEPTED)
 
 
 class UserNotificationSettingsViewSet(viewsets.ModelViewSet):
@@ -181,17 +191,12 @@ class UserNotificationSettingsViewSet(viewsets.ModelViewSet):
             return super().get_object()
 
         # For current user's settings
-        settings, created = UserNotificationSettings.objects.get_or_create(
-            user=self.request.user
-        )
-        return settings
+        return NotificationService.get_user_settings(self.request.user)
 
     @action(detail=False, methods=['get', 'put', 'patch'])
     def my_settings(self, request):
         """Get or update current user's notification settings"""
-        settings, created = UserNotificationSettings.objects.get_or_create(
-            user=request.user
-        )
+        settings = NotificationService.get_user_settings(request.user)
 
         if request.method == 'GET':
             serializer = self.get_serializer(settings)
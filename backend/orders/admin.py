@@ -24,7 +24,7 @@ class OrderAdmin(admin.ModelAdmin):
         'status', 'payment_status', 'delivery_county', 'created_at',
         'confirmed_at', 'delivered_at'
     ]
-    search_fields = ['order_id', 'buyer__first_name', 'buyer__last_name', 'buyer__email']
+    search_fields = ['order_id', 'buyer__email']
     readonly_fields = ['order_id', 'items_count', 'created_at', 'updated_at']
     inlines = [OrderItemInline, OrderTrackingInline]
 
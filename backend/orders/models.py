@@ -1,4 +1,6 @@
 from django.db import models
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 from decimal import Decimal
@@ -8,6 +10,30 @@ from products.models import Product
 
 User = get_user_model()
 
+class OrderQuerySet(models.QuerySet):
+    def with_farmers(self):
+        return self.prefetch_related('items__product__farmer')
+
+    def with_farmer_contacts(self):
+        # Just enough of each item to build Order.farmers for list rows
+        return self.prefetch_related(models.Prefetch(
+            'items',
+            queryset=OrderItem.objects.select_related('product__farmer').only(
+                'order_id', 'product__farmer__first_name',
+                'product__farmer__last_name', 'product__farmer__phone_number'
+            )
+        ))
+
+    def with_items_count(self):
+        # Correlated subquery rather than Count('items') so it stays correct
+        # however the outer queryset is filtered
+        items = OrderItem.objects.filter(
+            order=models.OuterRef('pk'), is_deleted=False
+        ).order_by().values('order').annotate(count=models.Count('pk')).values('count')
+        return self.annotate(
+            items_count_db=Coalesce(models.Subquery(items), 0)
+        )
+
 class Order(BaseModel):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -61,6 +87,8 @@ class Order(BaseModel):
     farmer_rating = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
     farmer_feedback = models.TextField(null=True, blank=True)
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created_at']
         indexes = [
@@ -82,12 +110,19 @@ class Order(BaseModel):
         self.total_amount = self.subtotal + self.delivery_fee + self.platform_fee
         self.save()
 
-    @property
+    @cached_property
     def farmers(self):
-        return User.objects.filter(products__orderitem__order=self).distinct()
+        # Walks items.all() so a queryset built with with_farmers() is served
+        # from the prefetch cache instead of issuing a JOIN + DISTINCT per order
+        farmers = {}
+        for item in self.items.all():
+            farmers.setdefault(item.product.farmer_id, item.product.farmer)
+        return list(farmers.values())
 
     @property
     def items_count(self):
+        if 'items' in getattr(self, '_prefetched_objects_cache', {}):
+            return len(self.items.all())
         return self.items.count()
 
 class OrderItem(BaseModel):
@@ -116,13 +151,21 @@ class Cart(BaseModel):
     def __str__(self):
         return f"Cart for {self.user.full_name}"
 
+    @staticmethod
+    def cache_key(user_id):
+        return f"cart:{user_id}"
+
+    @property
+    def active_items(self):
+        return self.items.filter(is_deleted=False)
+
     @property
     def items_count(self):
-        return self.items.count()
+        return self.active_items.count()
 
     @property
     def total_amount(self):
-        return sum(item.total_price for item in self.items.all())
+        return sum(item.total_price for item in self.active_items)
 
 class CartItem(BaseModel):
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
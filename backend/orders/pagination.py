@@ -0,0 +1,6 @@
+from rest_framework.pagination import CursorPagination
+
+
+class OrdersCursorPagination(CursorPagination):
+    """Keyset pagination on created_at; page depth doesn't affect query cost"""
+    ordering = '-created_at'
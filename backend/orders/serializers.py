@@ -1,12 +1,18 @@
 from rest_framework import serializers
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 from datetime import timedelta
+from decimal import Decimal
 from .models import (
     Order, OrderItem, Cart, CartItem, OrderTracking,
     DeliveryRequest, Invoice
 )
+from products.models import Product, ProductAnalytics
 from products.serializers import ProductListSerializer
+from .tasks import queue_tracking
 
 class CartItemSerializer(serializers.ModelSerializer):
     product = ProductListSerializer(read_only=True)
@@ -30,7 +36,6 @@ class CartItemSerializer(serializers.ModelSerializer):
         quantity = attrs.get('quantity')
 
         try:
-            from products.models import Product
             product = Product.objects.get(id=product_id, is_available=True, is_deleted=False)
 
             if quantity < product.minimum_order:
@@ -50,7 +55,7 @@ class CartItemSerializer(serializers.ModelSerializer):
         return attrs
 
 class CartSerializer(serializers.ModelSerializer):
-    items = CartItemSerializer(many=True, read_only=True)
+    items = CartItemSerializer(source='active_items', many=True, read_only=True)
     items_count = serializers.ReadOnlyField()
     total_amount = serializers.ReadOnlyField()
 
@@ -80,7 +85,7 @@ class OrderTrackingSerializer(serializers.ModelSerializer):
         ]
 
 class OrderListSerializer(serializers.ModelSerializer):
-    items_count = serializers.ReadOnlyField()
+    items_count = serializers.IntegerField(source='items_count_db', read_only=True)
     farmers = serializers.SerializerMethodField()
 
     class Meta:
@@ -152,73 +157,89 @@ class OrderCreateSerializer(serializers.ModelSerializer):
         # Create order
         order = Order.objects.create(buyer=user, **validated_data)
 
-        # Create order items
-        from products.models import Product
+        # Load every product in one query for pricing and validation
+        product_ids = [item_data['product_id'] for item_data in cart_items_data]
+        try:
+            products = Product.objects.filter(
+                is_available=True,
+                is_deleted=False
+            ).in_bulk(product_ids)
+        except (ValueError, DjangoValidationError):
+            raise serializers.ValidationError("Invalid product_id in cart items")
+        products = {str(pk): product for pk, product in products.items()}
+
+        order_items = []
         total_subtotal = 0
 
         for item_data in cart_items_data:
-            try:
-                product = Product.objects.get(
-                    id=item_data['product_id'],
-                    is_available=True,
-                    is_deleted=False
-                )
+            product = products.get(str(item_data['product_id']))
+            if product is None:
+                raise serializers.ValidationError(f"Product {item_data['product_id']} not found")
+
+            quantity = Decimal(str(item_data['quantity']))
 
-                quantity = float(item_data['quantity'])
-
-                # Validate quantity
-                if quantity < product.minimum_order:
-                    raise serializers.ValidationError(
-                        f"Minimum order for {product.name} is {product.minimum_order} {product.unit}"
-                    )
-
-                if quantity > product.quantity_available:
-                    raise serializers.ValidationError(
-                        f"Only {product.quantity_available} {product.unit} available for {product.name}"
-                    )
-
-                # Create order item
-                order_item = OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    quantity=quantity,
-                    unit_price=product.price_per_unit,
-                    special_instructions=item_data.get('special_instructions', '')
+            # Validate quantity
+            if quantity < product.minimum_order:
+                raise serializers.ValidationError(
+                    f"Minimum order for {product.name} is {product.minimum_order} {product.unit}"
                 )
 
-                total_subtotal += order_item.total_price
+            if quantity > product.quantity_available:
+                raise serializers.ValidationError(
+                    f"Only {product.quantity_available} {product.unit} available for {product.name}"
+                )
 
-                # Update product quantity
-                product.quantity_available -= quantity
-                product.save()
+            # bulk_create skips OrderItem.save(), so total_price is set here
+            order_item = OrderItem(
+                order=order,
+                product=product,
+                quantity=quantity,
+                unit_price=product.price_per_unit,
+                total_price=quantity * product.price_per_unit,
+                special_instructions=item_data.get('special_instructions', '')
+            )
+            order_items.append(order_item)
+            total_subtotal += order_item.total_price
+
+            # Decrement stock only if it still covers the quantity; the WHERE
+            # clause guards against overselling without row locks
+            updated = Product.objects.filter(
+                id=product.id,
+                quantity_available__gte=quantity,
+                is_available=True,
+                is_deleted=False
+            ).update(quantity_available=F('quantity_available') - quantity)
+            if not updated:
+                raise serializers.ValidationError(
+                    f"{product.name} is no longer available in the requested quantity"
+                )
 
-                # Update product analytics
-                analytics, created = product.analytics.get_or_create(product=product)
-                analytics.orders_count += 1
-                analytics.last_ordered = timezone.now()
-                analytics.save()
+        OrderItem.objects.bulk_create(order_items)
 
-            except Product.DoesNotExist:
-                raise serializers.ValidationError(f"Product {item_data['product_id']} not found")
+        # Upsert product analytics: insert missing rows (ON CONFLICT DO
+        # NOTHING), then increment every ordered product in one UPDATE
+        ordered_ids = [item.product_id for item in order_items]
+        ProductAnalytics.objects.bulk_create(
+            [ProductAnalytics(product_id=product_id) for product_id in ordered_ids],
+            ignore_conflicts=True
+        )
+        ProductAnalytics.objects.filter(product_id__in=ordered_ids).update(
+            orders_count=F('orders_count') + 1,
+            last_ordered=timezone.now()
+        )
 
         # Calculate order totals
         order.subtotal = total_subtotal
         order.calculate_totals()
 
-        # Create initial tracking
-        OrderTracking.objects.create(
-            order=order,
-            status='order_placed',
-            message='Order has been placed successfully',
-            updated_by=user
-        )
+        # Initial tracking is written by a worker once the order commits
+        queue_tracking(order, 'order_placed', 'Order has been placed successfully', user)
 
-        # Clear user's cart
-        try:
-            cart = Cart.objects.get(user=user)
-            cart.items.all().delete()
-        except Cart.DoesNotExist:
-            pass
+        # Clear user's cart, keeping the rows for analytics
+        CartItem.objects.filter(cart__user=user, is_deleted=False).update(
+            is_deleted=True, deleted_at=timezone.now()
+        )
+        cache.delete(Cart.cache_key(user.id))
 
         return order
 
@@ -0,0 +1,41 @@
+from celery import shared_task
+from django.db import transaction
+from .models import OrderTracking
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def record_tracking(order_id, status, message, user_id, location=None,
+                    latitude=None, longitude=None):
+    """
+    Record an order tracking entry
+    Queued by the order endpoints once their status change has committed
+    """
+    try:
+        tracking = OrderTracking.objects.create(
+            order_id=order_id,
+            status=status,
+            message=message,
+            location=location,
+            latitude=latitude,
+            longitude=longitude,
+            updated_by_id=user_id
+        )
+        return {'tracking_id': str(tracking.id)}
+
+    except Exception as e:
+        logger.error(f"Error in record_tracking task for order {order_id}: {e}")
+        return {'error': str(e)}
+
+
+def queue_tracking(order, status, message, user, location=None,
+                   latitude=None, longitude=None):
+    """Dispatch record_tracking after the current transaction commits"""
+    args = (
+        str(order.pk), status, message, user.pk, location,
+        str(latitude) if latitude is not None else None,
+        str(longitude) if longitude is not None else None,
+    )
+    transaction.on_commit(lambda: record_tracking.delay(*args))
@@ -2,11 +2,15 @@ from rest_framework import generics, permissions, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
+from django.core.cache import cache
 from django.utils import timezone
 from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse, OpenApiExample
 from drf_spectacular.types import OpenApiTypes
+from core.mixins import AutoPrefetchViewSetMixin
 from core.utils import APIResponse
+from products.models import Product
 from .models import (
     Order, OrderItem, Cart, CartItem, OrderTracking,
     DeliveryRequest, Invoice
@@ -16,6 +20,37 @@ from .serializers import (
     OrderDetailSerializer, OrderCreateSerializer, OrderStatusUpdateSerializer,
     OrderRatingSerializer, DeliveryRequestSerializer, InvoiceSerializer
 )
+from .pagination import OrdersCursorPagination
+from .tasks import queue_tracking
+
+# Serialized carts are cached per user and dropped on every cart mutation
+CART_CACHE_TIMEOUT = 300
+
+# Orders each role may see; roles not listed see none. The farmer filter is
+# a semi-join so it needs no DISTINCT over the joined items
+_ORDER_FILTERS = {
+    'buyer': lambda user: Q(buyer=user),
+    'farmer': lambda user: Exists(
+        OrderItem.objects.filter(order=OuterRef('pk'), product__farmer=user)
+    ),
+    'admin': lambda user: Q(),
+}
+
+def _orders_for(user, role=None):
+    order_filter = _ORDER_FILTERS.get(role or user.role)
+    if order_filter is None:
+        return Order.objects.none()
+    return Order.objects.filter(order_filter(user), is_deleted=False)
+
+def _order_ack(order):
+    # Mutation responses echo just the order state; clients fetch the
+    # detail endpoint when they need items and tracking
+    return {
+        'id': str(order.id),
+        'order_id': order.order_id,
+        'status': order.status,
+        'updated_at': order.updated_at,
+    }
 
 class CartView(generics.RetrieveAPIView):
     serializer_class = CartSerializer
@@ -25,6 +60,14 @@ class CartView(generics.RetrieveAPIView):
         cart, created = Cart.objects.get_or_create(user=self.request.user)
         return cart
 
+    def retrieve(self, request, *args, **kwargs):
+        cache_key = Cart.cache_key(request.user.id)
+        data = cache.get(cache_key)
+        if data is None:
+            data = self.get_serializer(self.get_object()).data
+            cache.set(cache_key, data, timeout=CART_CACHE_TIMEOUT)
+        return Response(data)
+
 @extend_schema(
     tags=['Orders'],
     summary='Add item to cart',
@@ -81,9 +124,21 @@ def add_to_cart(request):
         )
 
         if not created:
-            # Update quantity if item already exists
-            cart_item.quantity += quantity
-            cart_item.save()
+            # Increment in SQL so concurrent adds can't overwrite each other;
+            # a previously removed item starts again from the new quantity
+            new_quantity = quantity if cart_item.is_deleted else F('quantity') + quantity
+            CartItem.objects.filter(pk=cart_item.pk).update(
+                quantity=new_quantity,
+                unit_price=product.price_per_unit,
+                total_price=new_quantity * product.price_per_unit,
+                is_deleted=False,
+                deleted_at=None
+            )
+            cart_item.refresh_from_db(fields=[
+                'quantity', 'unit_price', 'total_price', 'is_deleted', 'deleted_at'
+            ])
+
+        cache.delete(Cart.cache_key(user.id))
 
         return Response(
             APIResponse.success(
@@ -102,7 +157,9 @@ def add_to_cart(request):
 @permission_classes([permissions.IsAuthenticated])
 def update_cart_item(request, item_id):
     try:
-        cart_item = CartItem.objects.get(
+        cart_item = CartItem.objects.select_related(
+            'product__farmer', 'product__category'
+        ).get(
             id=item_id,
             cart__user=request.user,
             is_deleted=False
@@ -130,7 +187,8 @@ def update_cart_item(request, item_id):
         )
 
     cart_item.quantity = quantity
-    cart_item.save()
+    cart_item.save(update_fields=['quantity', 'unit_price', 'total_price', 'updated_at'])
+    cache.delete(Cart.cache_key(request.user.id))
 
     return Response(
         APIResponse.success(
@@ -150,7 +208,8 @@ def remove_from_cart(request, item_id):
         )
         cart_item.is_deleted = True
         cart_item.deleted_at = timezone.now()
-        cart_item.save()
+        cart_item.save(update_fields=['is_deleted', 'deleted_at', 'updated_at'])
+        cache.delete(Cart.cache_key(request.user.id))
 
         return Response(
             APIResponse.success(message="Item removed from cart"),
@@ -167,7 +226,11 @@ def remove_from_cart(request, item_id):
 def clear_cart(request):
     try:
         cart = Cart.objects.get(user=request.user)
-        cart.items.update(is_deleted=True, deleted_at=timezone.now())
+        now = timezone.now()
+        cart.items.filter(is_deleted=False).update(is_deleted=True, deleted_at=now)
+        Cart.objects.filter(pk=cart.pk).update(updated_at=now)
+        # Drop the cached cart now so the next GET is consistent
+        cache.delete(Cart.cache_key(request.user.id))
 
         return Response(
             APIResponse.success(message="Cart cleared successfully"),
@@ -194,10 +257,7 @@ class OrderCreateView(generics.CreateAPIView):
         if serializer.is_valid():
             order = serializer.save()
             return Response(
-                APIResponse.success(
-                    OrderDetailSerializer(order, context={'request': request}).data,
-                    "Order created successfully"
-                ),
+                APIResponse.success(_order_ack(order), "Order created successfully"),
                 status=status.HTTP_201_CREATED
             )
 
@@ -206,68 +266,42 @@ class OrderCreateView(generics.CreateAPIView):
             status=status.HTTP_400_BAD_REQUEST
         )
 
-class OrderListView(generics.ListAPIView):
+class OrderListView(AutoPrefetchViewSetMixin, generics.ListAPIView):
     serializer_class = OrderListSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['status', 'payment_status']
     ordering = ['-created_at']
+    pagination_class = OrdersCursorPagination
 
     def get_queryset(self):
-        user = self.request.user
-        if user.role == 'buyer':
-            return Order.objects.filter(buyer=user, is_deleted=False)
-        elif user.role == 'farmer':
-            return Order.objects.filter(
-                items__product__farmer=user,
-                is_deleted=False
-            ).distinct()
-        elif user.role == 'admin':
-            return Order.objects.filter(is_deleted=False)
-        else:
-            return Order.objects.none()
+        # Only the columns OrderListSerializer renders
+        return _orders_for(self.request.user).with_farmer_contacts().with_items_count().only(
+            'id', 'order_id', 'status', 'payment_status', 'total_amount',
+            'delivery_county', 'expected_delivery_date', 'created_at', 'buyer_id'
+        )
 
-class OrderDetailView(generics.RetrieveAPIView):
+class OrderDetailView(AutoPrefetchViewSetMixin, generics.RetrieveAPIView):
     serializer_class = OrderDetailSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        user = self.request.user
-        if user.role == 'buyer':
-            return Order.objects.filter(buyer=user, is_deleted=False)
-        elif user.role == 'farmer':
-            return Order.objects.filter(
-                items__product__farmer=user,
-                is_deleted=False
-            ).distinct()
-        elif user.role == 'admin':
-            return Order.objects.filter(is_deleted=False)
-        else:
-            return Order.objects.none()
+        return _orders_for(self.request.user)
 
 @api_view(['PUT'])
 @permission_classes([permissions.IsAuthenticated])
 def update_order_status(request, order_id):
     try:
         user = request.user
-        if user.role == 'buyer':
-            order = Order.objects.get(id=order_id, buyer=user, is_deleted=False)
-        elif user.role == 'farmer':
-            order = Order.objects.filter(
-                id=order_id,
-                items__product__farmer=user,
-                is_deleted=False
-            ).distinct().first()
-            if not order:
-                raise Order.DoesNotExist
-        elif user.role == 'admin':
-            order = Order.objects.get(id=order_id, is_deleted=False)
-        else:
+        role = user.role
+        if role not in _ORDER_FILTERS:
             return Response(
                 APIResponse.error("Permission denied"),
                 status=status.HTTP_403_FORBIDDEN
             )
 
+        order = _orders_for(user, role).get(id=order_id)
+
     except Order.DoesNotExist:
         return Response(
             APIResponse.error("Order not found"),
@@ -294,24 +328,18 @@ def update_order_status(request, order_id):
         elif new_status == 'cancelled' and old_status != 'cancelled':
             order.cancelled_at = timezone.now()
 
-        order.save()
-
-        # Create tracking entry
-        OrderTracking.objects.create(
-            order=order,
-            status=new_status,
-            message=message,
-            location=location,
-            latitude=latitude,
-            longitude=longitude,
-            updated_by=user
+        order.save(update_fields=[
+            'status', 'confirmed_at', 'delivered_at', 'cancelled_at', 'updated_at'
+        ])
+
+        # Tracking is written by a worker
+        queue_tracking(
+            order, new_status, message, user,
+            location=location, latitude=latitude, longitude=longitude
         )
 
         return Response(
-            APIResponse.success(
-                OrderDetailSerializer(order, context={'request': request}).data,
-                "Order status updated successfully"
-            )
+            APIResponse.success(_order_ack(order), "Order status updated successfully")
         )
 
     return Response(
@@ -331,22 +359,26 @@ def cancel_order(request, order_id):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Update order status
-        order.status = 'cancelled'
-        order.cancelled_at = timezone.now()
-        order.save()
-
-        # Restore product quantities
-        for item in order.items.all():
-            item.product.quantity_available += item.quantity
-            item.product.save()
-
-        # Create tracking entry
-        OrderTracking.objects.create(
-            order=order,
-            status='cancelled',
-            message=request.data.get('reason', 'Order cancelled by buyer'),
-            updated_by=request.user
+        with transaction.atomic():
+            # Update order status
+            order.status = 'cancelled'
+            order.cancelled_at = timezone.now()
+            order.save(update_fields=['status', 'cancelled_at', 'updated_at'])
+
+            # Restore product quantities in a single UPDATE batch
+            items = list(order.items.all())
+            products = Product.objects.select_for_update().in_bulk(
+                [item.product_id for item in items]
+            )
+            for item in items:
+                products[item.product_id].quantity_available += item.quantity
+            Product.objects.bulk_update(products.values(), ['quantity_available'])
+
+        # Tracking is written by a worker
+        queue_tracking(
+            order, 'cancelled',
+            request.data.get('reason', 'Order cancelled by buyer'),
+            request.user
         )
 
         return Response(
@@ -375,16 +407,10 @@ def rate_order(request, order_id):
         if serializer.is_valid():
             data = serializer.validated_data
 
-            if 'buyer_rating' in data:
-                order.buyer_rating = data['buyer_rating']
-            if 'buyer_feedback' in data:
-                order.buyer_feedback = data['buyer_feedback']
-            if 'farmer_rating' in data:
-                order.farmer_rating = data['farmer_rating']
-            if 'farmer_feedback' in data:
-                order.farmer_feedback = data['farmer_feedback']
+            for field, value in data.items():
+                setattr(order, field, value)
 
-            order.save()
+            order.save(update_fields=[*data.keys(), 'updated_at'])
 
             return Response(
                 APIResponse.success(message="Rating submitted successfully")
@@ -401,30 +427,42 @@ def rate_order(request, order_id):
             status=status.HTTP_404_NOT_FOUND
         )
 
-class DeliveryRequestListView(generics.ListAPIView):
+class DeliveryRequestListView(AutoPrefetchViewSetMixin, generics.ListAPIView):
     serializer_class = DeliveryRequestSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['status', 'pickup_county']
     ordering = ['-created_at']
+    pagination_class = OrdersCursorPagination
 
-    def get_queryset(self):
+    def get_base_queryset(self):
         user = self.request.user
-        if user.role == 'transporter':
+        role = user.role
+        if role == 'transporter':
             return DeliveryRequest.objects.filter(
                 status='pending',
                 is_deleted=False
             )
-        elif user.role in ['farmer', 'buyer']:
+        elif role in ('farmer', 'buyer'):
             return DeliveryRequest.objects.filter(
                 order__buyer=user,
                 is_deleted=False
             )
-        elif user.role == 'admin':
+        elif role == 'admin':
             return DeliveryRequest.objects.filter(is_deleted=False)
         else:
             return DeliveryRequest.objects.none()
 
+    def get_queryset(self):
+        return self.get_base_queryset().select_related('order__buyer', 'transporter').only(
+            'id', 'status', 'pickup_address', 'pickup_county', 'pickup_contact',
+            'delivery_distance', 'estimated_cost', 'actual_cost',
+            'requires_refrigeration', 'requires_careful_handling', 'weight_estimate',
+            'accepted_at', 'picked_up_at', 'delivered_at', 'created_at',
+            'order__order_id', 'order__buyer__first_name', 'order__buyer__last_name',
+            'transporter__first_name', 'transporter__last_name'
+        )
+
 @api_view(['POST'])
 @permission_classes([permissions.IsAuthenticated])
 def accept_delivery_request(request, delivery_id):
@@ -435,7 +473,7 @@ def accept_delivery_request(request, delivery_id):
         )
 
     try:
-        delivery_request = DeliveryRequest.objects.get(
+        delivery_request = DeliveryRequest.objects.select_related('order__buyer').get(
             id=delivery_id,
             status='pending',
             is_deleted=False
@@ -444,19 +482,16 @@ def accept_delivery_request(request, delivery_id):
         delivery_request.transporter = request.user
         delivery_request.status = 'accepted'
         delivery_request.accepted_at = timezone.now()
-        delivery_request.save()
+        delivery_request.save(update_fields=['transporter', 'status', 'accepted_at', 'updated_at'])
 
         # Update order status
         order = delivery_request.order
         order.status = 'in_transit'
-        order.save()
-
-        # Create tracking entry
-        OrderTracking.objects.create(
-            order=order,
-            status='picked_up',
-            message=f"Order picked up by {request.user.full_name}",
-            updated_by=request.user
+        order.save(update_fields=['status', 'updated_at'])
+
+        # Tracking is written by a worker
+        queue_tracking(
+            order, 'picked_up', f"Order picked up by {request.user.full_name}", request.user
         )
 
         return Response(
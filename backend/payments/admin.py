@@ -6,13 +6,20 @@ from .models import (
 )
 
 
+def is_changelist(request):
+    """Whether the admin request is rendering a changelist"""
+    match = request.resolver_match
+    return bool(match and match.url_name and match.url_name.endswith('_changelist'))
+
+
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
     list_display = [
         'payment_id', 'order', 'payer', 'amount', 'currency',
         'payment_method', 'status', 'payment_date', 'created_at'
     ]
-    list_filter = ['status', 'payment_method', 'currency', 'created_at']
+    list_filter = ['status', 'payment_method', 'currency']
+    date_hierarchy = 'created_at'
     search_fields = ['payment_id', 'order__order_id', 'payer__email', 'external_transaction_id']
     readonly_fields = ['payment_id', 'created_at', 'updated_at']
     raw_id_fields = ['order', 'payer']
@@ -37,7 +44,12 @@ class PaymentAdmin(admin.ModelAdmin):
     )
 
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('order', 'payer')
+        # Order.__str__ reads the buyer's name
+        queryset = super().get_queryset(request).select_related('order__buyer', 'payer')
+        if is_changelist(request):
+            # The heavy text/JSON columns are only shown on the change form
+            queryset = queryset.defer('gateway_response', 'description', 'failure_reason')
+        return queryset
 
 
 @admin.register(MpesaTransaction)
@@ -53,6 +65,7 @@ class MpesaTransactionAdmin(admin.ModelAdmin):
     ]
     readonly_fields = ['created_at', 'updated_at']
     raw_id_fields = ['payment']
+    list_select_related = ['payment']
 
     fieldsets = (
         ('Transaction Details', {
@@ -81,6 +94,7 @@ class EscrowAccountAdmin(admin.ModelAdmin):
     search_fields = ['payment__payment_id', 'seller__email']
     readonly_fields = ['created_at', 'updated_at']
     raw_id_fields = ['payment', 'seller']
+    list_select_related = ['payment', 'seller']
 
     fieldsets = (
         ('Escrow Details', {
@@ -104,9 +118,10 @@ class PaymentWebhookAdmin(admin.ModelAdmin):
     list_display = [
         'webhook_type', 'payment', 'processed', 'created_at', 'source_ip'
     ]
-    list_filter = ['webhook_type', 'processed', 'created_at']
-    search_fields = ['payment__payment_id', 'source_ip']
-    readonly_fields = ['created_at', 'updated_at']
+    list_filter = ['webhook_type', 'processed']
+    date_hierarchy = 'created_at'
+    search_fields = ['payment__payment_id', 'source_ip', 'dedup_key']
+    readonly_fields = ['dedup_key', 'payload', 'created_at', 'updated_at']
     raw_id_fields = ['payment']
 
     fieldsets = (
@@ -114,10 +129,10 @@ class PaymentWebhookAdmin(admin.ModelAdmin):
             'fields': ('webhook_type', 'payment', 'processed')
         }),
         ('Request Details', {
-            'fields': ('source_ip', 'user_agent')
+            'fields': ('source_ip', 'user_agent', 'dedup_key')
         }),
         ('Data', {
-            'fields': ('raw_data', 'processing_error')
+            'fields': ('payload', 'processing_error')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
@@ -126,7 +141,10 @@ class PaymentWebhookAdmin(admin.ModelAdmin):
     )
 
     def get_queryset(self, request):
-        return super().get_queryset(request).select_related('payment')
+        # Payloads are only rendered on the change form
+        return super().get_queryset(request).select_related('payment').defer(
+            'raw_data', 'raw_data_compressed'
+        )
 
 
 @admin.register(PaymentRefund)
@@ -138,6 +156,7 @@ class PaymentRefundAdmin(admin.ModelAdmin):
     search_fields = ['payment__payment_id', 'refund_reference', 'external_refund_id']
     readonly_fields = ['created_at', 'updated_at']
     raw_id_fields = ['payment', 'processed_by']
+    list_select_related = ['payment', 'processed_by']
 
     fieldsets = (
         ('Refund Details', {
@@ -162,8 +181,7 @@ class PaymentAnalyticsAdmin(admin.ModelAdmin):
         'date', 'total_transactions', 'successful_transactions',
         'total_amount', 'amount_in_escrow'
     ]
-    list_filter = ['date']
-    search_fields = ['date']
+    date_hierarchy = 'date'
     readonly_fields = ['created_at', 'updated_at']
 
     fieldsets = (
@@ -187,3 +205,9 @@ class PaymentAnalyticsAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         })
     )
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if is_changelist(request):
+            queryset = queryset.only('id', *self.list_display)
+        return queryset
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+from datetime import date, timedelta
+from payments.models import Payment
+from payments.utils import PaymentAnalyticsCalculator
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily PaymentAnalytics rollup over a date range'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            type=date.fromisoformat,
+            help='First day to roll up (YYYY-MM-DD); defaults to the oldest payment'
+        )
+        parser.add_argument(
+            '--end',
+            type=date.fromisoformat,
+            help='Last day to roll up (YYYY-MM-DD); defaults to yesterday'
+        )
+
+    def handle(self, **options):
+        end = options['end'] or timezone.localdate() - timedelta(days=1)
+        start = options['start']
+        if start is None:
+            first_payment = Payment.objects.aggregate(first=Min('created_at'))['first']
+            if first_payment is None:
+                self.stdout.write(self.style.WARNING('No payments to roll up'))
+                return
+            start = timezone.localdate(first_payment)
+
+        if start > end:
+            raise CommandError(f'--start {start} is after --end {end}')
+
+        day = start
+        while day <= end:
+            metrics = PaymentAnalyticsCalculator.rollup_day(day)
+            self.stdout.write(f"{day}: {metrics['total_transactions']} transactions")
+            day += timedelta(days=1)
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Rolled up payment analytics from {start} to {end}')
+        )
@@ -1,12 +1,16 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 from datetime import timedelta
-from payments.models import Payment
-from payments.services import MpesaService
+from payments.models import Payment, MpesaTransaction
+from payments.services import mpesa_service
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Pending payments fetched, queried and written back per round
+SYNC_CHUNK_SIZE = 500
+
 
 class Command(BaseCommand):
     help = 'Sync payment status with external gateways'
@@ -52,21 +56,40 @@ class Command(BaseCommand):
         if payment_method:
             filters['payment_method'] = payment_method
 
-        pending_payments = Payment.objects.filter(**filters)
-
-        self.stdout.write(f'Found {pending_payments.count()} pending payments to check')
+        # Streamed in chunks so a large backlog is never held in memory at once
+        # Cash sync reads the order's delivery status
+        pending_payments = Payment.objects.filter(**filters).select_related(
+            'mpesa_transaction', 'order'
+        ).iterator(chunk_size=SYNC_CHUNK_SIZE)
 
+        checked_count = 0
         updated_count = 0
         error_count = 0
+        mpesa_payments = []
+        cash_payment_ids = []
 
         for payment in pending_payments:
+            checked_count += 1
             try:
                 if payment.payment_method == 'mpesa':
-                    updated = self.sync_mpesa_payment(payment, dry_run)
+                    # Queried concurrently, one chunk at a time
+                    mpesa_payments.append(payment)
+                    if len(mpesa_payments) >= SYNC_CHUNK_SIZE:
+                        updated_count += self.sync_mpesa_payments(mpesa_payments, dry_run)
+                        mpesa_payments = []
+                    continue
                 elif payment.payment_method == 'bank':
                     updated = self.sync_bank_payment(payment, dry_run)
                 elif payment.payment_method == 'cash':
-                    updated = self.sync_cash_payment(payment, dry_run)
+                    # Delivered cash payments are completed together below
+                    if self.sync_cash_payment(payment):
+                        cash_payment_ids.append(payment.pk)
+                        if len(cash_payment_ids) >= SYNC_CHUNK_SIZE:
+                            updated_count += self.complete_cash_payments(
+                                cash_payment_ids, dry_run
+                            )
+                            cash_payment_ids = []
+                    continue
                 else:
                     self.stdout.write(
                         self.style.WARNING(f'Unknown payment method: {payment.payment_method}')
@@ -83,58 +106,85 @@ class Command(BaseCommand):
                 )
                 logger.error(f'Error syncing payment {payment.payment_id}: {e}')
 
+        updated_count += self.sync_mpesa_payments(mpesa_payments, dry_run)
+        updated_count += self.complete_cash_payments(cash_payment_ids, dry_run)
+
+        self.stdout.write(f'Checked {checked_count} pending payments')
         self.stdout.write(
             self.style.SUCCESS(
                 f'Sync completed: {updated_count} updated, {error_count} errors'
             )
         )
 
-    def sync_mpesa_payment(self, payment, dry_run=False):
-        """Sync M-Pesa payment status"""
-        try:
-            mpesa_transaction = payment.mpesa_transaction
-            if not mpesa_transaction or not mpesa_transaction.checkout_request_id:
-                return False
-
-            mpesa_service = MpesaService()
-            result = mpesa_service.query_stk_status(mpesa_transaction.checkout_request_id)
-
-            if result['success']:
-                data = result['data']
-                result_code = data.get('ResultCode')
-
-                self.stdout.write(f'M-Pesa query result for {payment.payment_id}: {result_code}')
-
-                if not dry_run:
-                    # Update transaction
-                    mpesa_transaction.result_code = str(result_code)
-                    mpesa_transaction.result_desc = data.get('ResultDesc')
-                    mpesa_transaction.save()
-
-                    # Update payment status
-                    if result_code == '0':  # Success
-                        payment.status = 'completed'
-                        payment.payment_date = timezone.now()
-                    elif result_code in ['1032', '1037']:  # Cancelled/timeout
-                        payment.status = 'cancelled'
-                    else:  # Other failures
-                        payment.status = 'failed'
-                        payment.failure_reason = data.get('ResultDesc')
-
-                    payment.save()
-
-                return True
-            else:
+    def sync_mpesa_payments(self, payments, dry_run=False):
+        """
+        Sync M-Pesa payment statuses
+        STK queries run concurrently and the results are written in two bulk updates
+        """
+        queryable = [
+            payment for payment in payments
+            if hasattr(payment, 'mpesa_transaction') and payment.mpesa_transaction.checkout_request_id
+        ]
+        if not queryable:
+            return 0
+
+        results = mpesa_service.query_stk_statuses(
+            payment.mpesa_transaction.checkout_request_id for payment in queryable
+        )
+
+        now = timezone.now()
+        payments_to_update = []
+        transactions_to_update = []
+        for payment in queryable:
+            result = results[payment.mpesa_transaction.checkout_request_id]
+            if not result['success']:
                 self.stdout.write(
-                    self.style.WARNING(f'Failed to query M-Pesa status: {result["message"]}')
+                    self.style.WARNING(
+                        f'Failed to query M-Pesa status: {result.get("message", result.get("data"))}'
+                    )
+                )
+                continue
+
+            self.apply_mpesa_result(payment, result['data'], now)
+            payments_to_update.append(payment)
+            transactions_to_update.append(payment.mpesa_transaction)
+
+        if not dry_run and payments_to_update:
+            # Each bulk_update is a single UPDATE ... SET col = CASE WHEN pk = ...
+            # per batch; leaving batch_size unset lets the backend pick the
+            # largest batch it supports (the whole run on PostgreSQL)
+            with transaction.atomic():
+                Payment.objects.bulk_update(
+                    payments_to_update,
+                    ['status', 'payment_date', 'failure_reason', 'updated_at']
+                )
+                MpesaTransaction.objects.bulk_update(
+                    transactions_to_update,
+                    ['result_code', 'result_desc', 'updated_at']
                 )
-                return False
 
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f'Error syncing M-Pesa payment: {str(e)}')
-            )
-            return False
+        return len(payments_to_update)
+
+    def apply_mpesa_result(self, payment, data, now):
+        """Apply an STK query result to a payment and its M-Pesa transaction in memory"""
+        result_code = data.get('ResultCode')
+
+        self.stdout.write(f'M-Pesa query result for {payment.payment_id}: {result_code}')
+
+        # bulk_update skips auto_now, so updated_at is set here
+        mpesa_transaction = payment.mpesa_transaction
+        mpesa_transaction.result_code = str(result_code)
+        mpesa_transaction.result_desc = data.get('ResultDesc')
+        mpesa_transaction.updated_at = now
+
+        new_status = mpesa_service.payment_status_for(result_code)
+        if new_status:
+            payment.status = new_status
+        if new_status == 'completed':
+            payment.payment_date = now
+        elif new_status == 'failed':
+            payment.failure_reason = data.get('ResultDesc')
+        payment.updated_at = now
 
     def sync_bank_payment(self, payment, dry_run=False):
         """Sync bank payment status (manual verification needed)"""
@@ -143,18 +193,24 @@ class Command(BaseCommand):
         self.stdout.write(f'Bank payment {payment.payment_id} requires manual verification')
         return False
 
-    def sync_cash_payment(self, payment, dry_run=False):
-        """Sync cash payment status"""
+    def sync_cash_payment(self, payment):
+        """Whether a cash payment is due, i.e. its order has been delivered"""
         # Cash payments are typically updated when delivery is completed
-        # Check if associated order is delivered
         if payment.order and payment.order.status == 'delivered':
             self.stdout.write(f'Cash payment {payment.payment_id} - order delivered, updating status')
+            return True
 
-            if not dry_run:
-                payment.status = 'completed'
-                payment.payment_date = timezone.now()
-                payment.save()
+        return False
 
-            return True
+    def complete_cash_payments(self, payment_ids, dry_run=False):
+        """Mark delivered cash payments completed with a single UPDATE"""
+        if not payment_ids:
+            return 0
+        if dry_run:
+            return len(payment_ids)
 
-        return False
\ No newline at end of file
+        now = timezone.now()
+        return Payment.objects.filter(
+            pk__in=payment_ids,
+            status__in=['pending', 'processing']
+        ).update(status='completed', payment_date=now, updated_at=now)
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='paymentanalytics',
+            unique_together=set(),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['checkout_request_id'], name='payments_mp_checkou_9552b8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mpesatransaction',
+            index=models.Index(fields=['mpesa_receipt_number'], name='payments_mp_mpesa_r_8c8669_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'created_at'], name='pay_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payment_method', 'status'], name='payments_pa_payment_11cbdd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['external_transaction_id'], name='payments_pa_externa_77ac9f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymentrefund',
+            index=models.Index(fields=['payment', 'status'], name='payments_re_payment_4444a0_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paymentwebhook',
+            index=models.Index(fields=['processed', 'created_at'], name='payments_we_process_450aa9_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='paymentanalytics',
+            constraint=models.UniqueConstraint(fields=('date',), name='unique_payment_analytics_date'),
+        ),
+    ]
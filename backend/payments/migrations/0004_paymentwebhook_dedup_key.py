@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0003_payment_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentwebhook',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0004_paymentwebhook_dedup_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentwebhook',
+            name='raw_data_compressed',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='paymentwebhook',
+            name='raw_data',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
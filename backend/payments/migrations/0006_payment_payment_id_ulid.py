@@ -0,0 +1,19 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+import core.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0005_paymentwebhook_raw_data_compressed'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='payment_id',
+            field=models.CharField(default=core.utils.generate_ulid, max_length=26, unique=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+import core.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0006_payment_payment_id_ulid'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='gateway_response',
+            field=models.JSONField(blank=True, decoder=core.fields.OrjsonDecoder, encoder=core.fields.OrjsonEncoder, null=True),
+        ),
+        migrations.AlterField(
+            model_name='paymentrefund',
+            name='gateway_response',
+            field=models.JSONField(blank=True, decoder=core.fields.OrjsonDecoder, encoder=core.fields.OrjsonEncoder, null=True),
+        ),
+        migrations.AlterField(
+            model_name='paymentwebhook',
+            name='raw_data',
+            field=models.JSONField(blank=True, decoder=core.fields.OrjsonDecoder, encoder=core.fields.OrjsonEncoder, null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0007_orjson_json_fields'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paymentwebhook',
+            index=models.Index(fields=['created_at'], name='pay_webhook_created_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0008_paymentwebhook_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='escrowaccount',
+            index=models.Index(fields=['status', 'release_date'], name='payments_es_status_4bfcaf_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='escrowaccount',
+            index=models.Index(fields=['status', 'created_at'], name='payments_es_status_c51231_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+def clear_duplicate_checkout_ids(apps, schema_editor):
+    """
+    Keep each checkout_request_id on its most recently updated transaction
+    and clear it from older duplicates, which Daraja no longer reports on
+    """
+    MpesaTransaction = apps.get_model('payments', 'MpesaTransaction')
+    latest = MpesaTransaction.objects.filter(
+        checkout_request_id=models.OuterRef('checkout_request_id')
+    ).order_by('-updated_at', '-created_at').values('pk')[:1]
+    MpesaTransaction.objects.filter(checkout_request_id__isnull=False).exclude(
+        pk=models.Subquery(latest)
+    ).update(checkout_request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0009_escrow_status_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_checkout_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='mpesatransaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='mpesatransaction',
+            name='payments_mp_checkou_9552b8_idx',
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['payer', '-created_at'], name='pay_payer_created_idx'),
+        ),
+    ]
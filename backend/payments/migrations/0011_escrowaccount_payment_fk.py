@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0010_payment_payer_idx_unique_checkout'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='escrowaccount',
+            name='payment',
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='escrows',
+                to='payments.payment',
+            ),
+        ),
+    ]
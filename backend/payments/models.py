@@ -1,12 +1,20 @@
+import zlib
+import orjson
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 from decimal import Decimal
+from core.fields import OrjsonDecoder, OrjsonEncoder
 from core.models import BaseModel
-from core.utils import generate_transaction_id
+from core.utils import generate_ulid
 
 User = get_user_model()
 
+# Length of Payment.reference, the limit Daraja puts on AccountReference
+PAYMENT_REFERENCE_LENGTH = 12
+
 
 class Payment(BaseModel):
     """Main payment record for orders"""
@@ -25,7 +33,7 @@ class Payment(BaseModel):
         ('refunded', 'Refunded'),
     ]
 
-    payment_id = models.CharField(max_length=20, unique=True, default=generate_transaction_id)
+    payment_id = models.CharField(max_length=26, unique=True, default=generate_ulid)
     order = models.ForeignKey('orders.Order', on_delete=models.CASCADE, related_name='payments')
     payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments_made')
 
@@ -36,7 +44,9 @@ class Payment(BaseModel):
 
     # External payment references
     external_transaction_id = models.CharField(max_length=100, null=True, blank=True)
-    gateway_response = models.JSONField(null=True, blank=True)
+    gateway_response = models.JSONField(
+        null=True, blank=True, encoder=OrjsonEncoder, decoder=OrjsonDecoder
+    )
 
     # Metadata
     description = models.TextField(null=True, blank=True)
@@ -46,10 +56,24 @@ class Payment(BaseModel):
     class Meta:
         db_table = 'payments_payment'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='pay_status_created_idx'),
+            models.Index(fields=['payer', '-created_at'], name='pay_payer_created_idx'),
+            models.Index(fields=['payment_method', 'status']),
+            models.Index(fields=['external_transaction_id']),
+        ]
 
     def __str__(self):
         return f"Payment {self.payment_id} - {self.amount} {self.currency}"
 
+    @property
+    def reference(self) -> str:
+        """
+        Short customer-facing reference: the random tail of the ULID. Daraja
+        caps AccountReference at 12 characters, and bank customers type it by hand
+        """
+        return self.payment_id[-PAYMENT_REFERENCE_LENGTH:]
+
 
 class MpesaTransaction(BaseModel):
     """M-Pesa specific transaction details"""
@@ -66,7 +90,7 @@ class MpesaTransaction(BaseModel):
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPE_CHOICES, default='paybill')
 
     # Daraja API specific fields
-    checkout_request_id = models.CharField(max_length=100, null=True, blank=True)
+    checkout_request_id = models.CharField(max_length=100, null=True, blank=True, unique=True)
     merchant_request_id = models.CharField(max_length=100, null=True, blank=True)
     result_code = models.CharField(max_length=10, null=True, blank=True)
     result_desc = models.TextField(null=True, blank=True)
@@ -78,6 +102,9 @@ class MpesaTransaction(BaseModel):
 
     class Meta:
         db_table = 'payments_mpesa_transaction'
+        indexes = [
+            models.Index(fields=['mpesa_receipt_number']),
+        ]
 
     def __str__(self):
         return f"M-Pesa {self.phone_number} - {self.mpesa_receipt_number}"
@@ -93,7 +120,7 @@ class EscrowAccount(BaseModel):
         ('disputed', 'Disputed'),
     ]
 
-    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name='escrow')
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='escrows')
     seller = models.ForeignKey(User, on_delete=models.CASCADE, related_name='escrow_accounts')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='active')
@@ -109,6 +136,10 @@ class EscrowAccount(BaseModel):
 
     class Meta:
         db_table = 'payments_escrow_account'
+        indexes = [
+            models.Index(fields=['status', 'release_date']),
+            models.Index(fields=['status', 'created_at']),
+        ]
 
     def __str__(self):
         return f"Escrow {self.payment.payment_id} - {self.amount} KES"
@@ -125,8 +156,11 @@ class PaymentWebhook(BaseModel):
     webhook_type = models.CharField(max_length=50, choices=WEBHOOK_TYPE_CHOICES)
     payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='webhooks')
 
-    # Raw webhook data
-    raw_data = models.JSONField()
+    # Raw webhook data; archived rows keep it zlib-compressed instead
+    raw_data = models.JSONField(
+        null=True, blank=True, encoder=OrjsonEncoder, decoder=OrjsonDecoder
+    )
+    raw_data_compressed = models.BinaryField(null=True, blank=True, editable=False)
     processed = models.BooleanField(default=False)
     processing_error = models.TextField(null=True, blank=True)
 
@@ -134,13 +168,53 @@ class PaymentWebhook(BaseModel):
     source_ip = models.GenericIPAddressField(null=True, blank=True)
     user_agent = models.CharField(max_length=500, null=True, blank=True)
 
+    # Collapses gateway redeliveries of the same callback
+    dedup_key = models.CharField(max_length=100, null=True, blank=True, unique=True)
+
     class Meta:
         db_table = 'payments_webhook'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['processed', 'created_at']),
+            # Backs the default ordering, date drill-down and age-based purge
+            models.Index(fields=['created_at'], name='pay_webhook_created_idx'),
+        ]
 
     def __str__(self):
         return f"Webhook {self.webhook_type} - {self.created_at}"
 
+    def save(self, *args, **kwargs):
+        if not self.dedup_key:
+            self.dedup_key = self.dedup_key_for(self.raw_data)
+        super().save(*args, **kwargs)
+
+    @property
+    def payload(self):
+        """Return the webhook payload, inflating it for archived rows"""
+        if self.raw_data is None and self.raw_data_compressed:
+            return orjson.loads(zlib.decompress(self.raw_data_compressed))
+        return self.raw_data
+
+    def archive_payload(self):
+        """Move raw_data into the compressed column (caller saves)"""
+        if self.raw_data is not None:
+            self.raw_data_compressed = zlib.compress(
+                orjson.dumps(self.raw_data, option=orjson.OPT_NON_STR_KEYS)
+            )
+            self.raw_data = None
+
+    @staticmethod
+    def dedup_key_for(raw_data):
+        """Return the M-Pesa CheckoutRequestID identifying a callback payload"""
+        if not isinstance(raw_data, dict):
+            return None
+        body = raw_data.get('Body')
+        stk_callback = body.get('stkCallback') if isinstance(body, dict) else None
+        if not isinstance(stk_callback, dict):
+            return None
+        checkout_request_id = stk_callback.get('CheckoutRequestID')
+        return checkout_request_id if isinstance(checkout_request_id, str) else None
+
 
 class PaymentRefund(BaseModel):
     """Refund records for payments"""
@@ -163,10 +237,15 @@ class PaymentRefund(BaseModel):
 
     # External refund details
     external_refund_id = models.CharField(max_length=100, null=True, blank=True)
-    gateway_response = models.JSONField(null=True, blank=True)
+    gateway_response = models.JSONField(
+        null=True, blank=True, encoder=OrjsonEncoder, decoder=OrjsonDecoder
+    )
 
     class Meta:
         db_table = 'payments_refund'
+        indexes = [
+            models.Index(fields=['payment', 'status']),
+        ]
 
     def __str__(self):
         return f"Refund {self.payment.payment_id} - {self.amount} KES"
@@ -195,7 +274,21 @@ class PaymentAnalytics(BaseModel):
 
     class Meta:
         db_table = 'payments_analytics'
-        unique_together = ['date']
+        constraints = [
+            models.UniqueConstraint(fields=['date'], name='unique_payment_analytics_date'),
+        ]
 
     def __str__(self):
         return f"Payment Analytics {self.date}"
+
+    @classmethod
+    def increment(cls, date, **deltas):
+        """
+        Add ``deltas`` to the counters for ``date`` with a single UPDATE,
+        creating the day's row first if it does not exist yet
+        """
+        cls.objects.bulk_create([cls(date=date)], ignore_conflicts=True)
+        return cls.objects.filter(date=date).update(
+            updated_at=timezone.now(),
+            **{field: F(field) + delta for field, delta in deltas.items()}
+        )
@@ -1,5 +1,10 @@
+import re
+from decimal import Decimal
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from orders.models import Order
 from .models import (
     Payment, MpesaTransaction, EscrowAccount,
     PaymentWebhook, PaymentRefund, PaymentAnalytics
@@ -7,32 +12,49 @@ from .models import (
 
 User = get_user_model()
 
+PHONE_RE = re.compile(r'^(\+254|254|0)?[17]\d{8}$')
+
+# Allowed payment status transitions
+_ALLOWED_TRANSITIONS = {
+    'pending': frozenset(('processing', 'cancelled')),
+    'processing': frozenset(('completed', 'failed', 'cancelled')),
+    'completed': frozenset(('refunded',)),
+    'failed': frozenset(('pending',)),  # Allow retry
+    'cancelled': frozenset(),  # No transitions from cancelled
+    'refunded': frozenset(),  # No transitions from refunded
+}
+
+
+class PaymentOrderSummarySerializer(serializers.ModelSerializer):
+    """Order summary embedded in payment responses"""
+
+    class Meta:
+        model = Order
+        fields = ['order_id', 'total_amount', 'status']
+        read_only_fields = fields
+
 
 class PaymentSerializer(serializers.ModelSerializer):
     """Payment serializer for API responses"""
+    order_details = PaymentOrderSummarySerializer(source='order', read_only=True)
 
     class Meta:
         model = Payment
         fields = [
             'id', 'payment_id', 'order', 'payer', 'amount', 'currency',
             'payment_method', 'status', 'description', 'payment_date',
-            'external_transaction_id', 'failure_reason', 'created_at', 'updated_at'
+            'external_transaction_id', 'failure_reason', 'created_at', 'updated_at',
+            'order_details'
         ]
         read_only_fields = [
             'id', 'payment_id', 'payer', 'external_transaction_id',
             'payment_date', 'failure_reason', 'created_at', 'updated_at'
         ]
 
-    def to_representation(self, instance):
-        data = super().to_representation(instance)
-        # Add related order information
-        if instance.order:
-            data['order_details'] = {
-                'order_id': instance.order.order_id,
-                'total_amount': instance.order.total_amount,
-                'status': instance.order.status
-            }
-        return data
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        """Join the order rendered in order_details"""
+        return queryset.select_related('order')
 
 
 class PaymentCreateSerializer(serializers.ModelSerializer):
@@ -49,9 +71,7 @@ class PaymentCreateSerializer(serializers.ModelSerializer):
         """Validate phone number for M-Pesa payments"""
         if value:
             # Basic Kenyan phone number validation
-            import re
-            pattern = r'^(\+254|254|0)?[17]\d{8}$'
-            if not re.match(pattern, value):
+            if not PHONE_RE.match(value):
                 raise serializers.ValidationError(
                     "Invalid Kenyan phone number format"
                 )
@@ -70,7 +90,7 @@ class PaymentCreateSerializer(serializers.ModelSerializer):
 
         # Validate order exists and belongs to user
         order = attrs.get('order')
-        if order and order.buyer != self.context['request'].user:
+        if order and order.buyer_id != self.context['request'].user.id:
             raise serializers.ValidationError({
                 'order': 'You can only make payments for your own orders'
             })
@@ -156,18 +176,23 @@ class PaymentRefundCreateSerializer(serializers.ModelSerializer):
         payment = attrs.get('payment')
         amount = attrs.get('amount')
 
-        if payment and amount > payment.amount:
+        # Payment amount and its active refund total in one query
+        totals = Payment.objects.filter(pk=payment.pk).annotate(
+            refunded=Coalesce(
+                Sum(
+                    'refunds__amount',
+                    filter=Q(refunds__status__in=['pending', 'processing', 'completed'])
+                ),
+                Decimal('0')
+            )
+        ).values('amount', 'refunded').first()
+
+        if amount > totals['amount']:
             raise serializers.ValidationError({
                 'amount': 'Refund amount cannot exceed payment amount'
             })
 
-        # Check for existing refunds
-        existing_refunds = PaymentRefund.objects.filter(
-            payment=payment,
-            status__in=['pending', 'processing', 'completed']
-        ).aggregate(total=serializers.Sum('amount'))['total'] or 0
-
-        if existing_refunds + amount > payment.amount:
+        if totals['refunded'] + amount > totals['amount']:
             raise serializers.ValidationError({
                 'amount': 'Total refunds cannot exceed payment amount'
             })
@@ -212,18 +237,8 @@ class PaymentStatusUpdateSerializer(serializers.Serializer):
         if not payment:
             return value
 
-        # Define allowed status transitions
-        allowed_transitions = {
-            'pending': ['processing', 'cancelled'],
-            'processing': ['completed', 'failed', 'cancelled'],
-            'completed': ['refunded'],
-            'failed': ['pending'],  # Allow retry
-            'cancelled': [],  # No transitions from cancelled
-            'refunded': []  # No transitions from refunded
-        }
-
         current_status = payment.status
-        if value not in allowed_transitions.get(current_status, []):
+        if value not in _ALLOWED_TRANSITIONS.get(current_status, ()):
             raise serializers.ValidationError(
                 f"Cannot change status from {current_status} to {value}"
             )
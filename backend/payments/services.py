@@ -1,14 +1,171 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
+import orjson
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone as django_timezone
-from typing import Dict, Optional, Tuple
+from typing import Dict, Iterable, Optional, Tuple
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+class DarajaRetry(Retry):
+    """Retry policy that takes a Daraja rate-limit slot before every re-send"""
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        _acquire_daraja_slot(getattr(settings, 'MPESA_RATE_LIMIT', 10))
+
+
+# Transient Daraja failures and throttling are retried on the pooled connection
+# with jittered exponential backoff, honouring any Retry-After header. Once the
+# retries run out the last response is returned for the caller to handle. Only
+# idempotent calls (the token GET and STK status queries) use this policy
+DARAJA_RETRY = DarajaRetry(
+    total=4,
+    backoff_factor=0.5,
+    backoff_jitter=0.25,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({'GET', 'POST'}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# An STK push that fails with a 5xx or a read error may already have sent the
+# customer a PIN prompt, and re-sending it could charge them twice. Pushes are
+# only retried when Daraja refused them outright: connection failures, 429, and
+# 503 with Retry-After
+DARAJA_PUSH_RETRY = DarajaRetry(
+    total=4,
+    read=0,
+    other=0,
+    backoff_factor=0.5,
+    backoff_jitter=0.25,
+    status_forcelist=(429,),
+    allowed_methods=frozenset({'POST'}),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+
+def _build_session(retry: Retry) -> requests.Session:
+    """
+    Shared HTTP session so Daraja calls reuse pooled keep-alive connections
+    instead of paying a TCP+TLS handshake per request
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=50,
+        max_retries=retry
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_session = _build_session(DARAJA_RETRY)
+_push_session = _build_session(DARAJA_PUSH_RETRY)
+
+# (connect, read) seconds for Daraja calls. An unreachable host fails fast
+# instead of pinning a web or Celery worker for the full read timeout
+DARAJA_TIMEOUT = (5, 30)
+
+# Concurrent Daraja STK status queries; the calls are network-bound
+STK_QUERY_WORKERS = 16
+
+# Payment status for each STK result code; any other code is a failure
+STK_RESULT_STATUSES = {
+    '0': 'completed',
+    '1032': 'cancelled',  # Cancelled by user
+    '1037': 'cancelled',  # Timed out waiting for the user
+}
+
+# Daraja tokens last an hour; refresh a minute before they expire
+TOKEN_EXPIRY_MARGIN = 60
+_token_lock = threading.Lock()
+
+# Process-local copy of the cached token (cache key -> (token, monotonic expiry)).
+# A token read from the shared cache is still valid for at least the expiry
+# margin, so holding it that long locally is safe and spares a cache round-trip
+_token_memo: Dict[str, Tuple[str, float]] = {}
+
+# Daraja timestamps are East Africa Time, which is a fixed UTC+3 with no DST
+DARAJA_UTC_OFFSET = 3 * 60 * 60
+
+# Kenyan MSISDN as 07XX..., +2547XX..., 2547XX... or the bare 9-digit subscriber number
+_PHONE_RE = re.compile(r'^(?:\+?254|0)?(\d{9})$')
+
+# M-Pesa callback source IPs (update as needed)
+MPESA_CALLBACK_IPS = frozenset({
+    '196.201.214.200',
+    '196.201.214.206',
+    '196.201.213.114',
+    '196.201.214.207',
+    '196.201.214.208',
+    '196.201.213.44',
+    '196.201.212.127',
+    '196.201.212.138',
+    '196.201.212.129',
+    '196.201.212.136',
+    '196.201.212.74',
+})
+# For sandbox, allow localhost and common development IPs
+MPESA_SANDBOX_CALLBACK_IPS = MPESA_CALLBACK_IPS | {'127.0.0.1', '::1', '0.0.0.0'}
+
+
+
+def _parse_transaction_date(value) -> Optional[datetime]:
+    """Convert a callback TransactionDate timestamp to a datetime"""
+    if not value:
+        return None
+    try:
+        return datetime.fromtimestamp(int(value), tz=timezone.utc)
+    except (ValueError, TypeError):
+        return None
+
+
+# Callback metadata item Name -> (metadata key, value converter)
+CALLBACK_METADATA_PARSERS = {
+    'Amount': ('amount', float),
+    'MpesaReceiptNumber': ('mpesa_receipt_number', lambda value: value),
+    'TransactionDate': ('transaction_date', _parse_transaction_date),
+    'PhoneNumber': ('phone_number', lambda value: value),
+    'Balance': ('balance', lambda value: float(value) if value else None),
+}
+
+
+def _acquire_daraja_slot(limit: int) -> None:
+    """
+    Block until a Daraja request slot is free in the current one-second window.
+    The counter lives in the shared cache so every worker draws from one quota.
+    If the cache is unreachable the request goes ahead unthrottled
+    """
+    while True:
+        window = int(time.time())
+        key = f'mpesa:rate:{window}'
+        try:
+            cache.add(key, 0, timeout=2)
+            count = cache.incr(key)
+        except ValueError:
+            # Window key expired between add() and incr(); take a fresh window
+            continue
+        except Exception as e:
+            logger.warning(f"Daraja rate limiter unavailable, not throttling: {e}")
+            return
+        if count <= limit:
+            return
+        time.sleep(max(window + 1 - time.time(), 0))
+
+
 class MpesaService:
     """M-Pesa Daraja API integration service"""
 
@@ -19,32 +176,78 @@ class MpesaService:
         self.shortcode = getattr(settings, 'MPESA_SHORTCODE', '174379')
         self.passkey = getattr(settings, 'MPESA_PASSKEY', '')
         self.callback_url = getattr(settings, 'MPESA_CALLBACK_URL', '')
+        self.rate_limit = getattr(settings, 'MPESA_RATE_LIMIT', 10)
 
         if self.environment == 'production':
             self.base_url = 'https://api.safaricom.co.ke'
         else:
             self.base_url = 'https://sandbox.safaricom.co.ke'
 
-    def get_access_token(self) -> Optional[str]:
-        """Get OAuth access token from M-Pesa API"""
+        # Credentials are fixed for the service's lifetime, so encode them once
+        self._password_prefix = f"{self.shortcode}{self.passkey}".encode()
+        self._basic_auth = base64.b64encode(
+            f"{self.consumer_key}:{self.consumer_secret}".encode('ascii')
+        ).decode('ascii')
+
+    @property
+    def token_cache_key(self) -> str:
+        return f'mpesa:token:{self.environment}'
+
+    def get_access_token(self, refresh: bool = False) -> Optional[str]:
+        """
+        Get OAuth access token from M-Pesa API
+        Tokens are cached until shortly before expiry; ``refresh`` forces a new one
+        """
+        if not refresh:
+            token = self._cached_access_token()
+            if token:
+                return token
+
+        # One fetch per process at a time; later callers pick up the cached token
+        with _token_lock:
+            if not refresh:
+                token = self._cached_access_token()
+                if token:
+                    return token
+            return self._fetch_access_token()
+
+    def _cached_access_token(self) -> Optional[str]:
+        """Return the current token from the process memo or the shared cache"""
+        key = self.token_cache_key
+        memo = _token_memo.get(key)
+        if memo and memo[1] > time.monotonic():
+            return memo[0]
+
+        token = cache.get(key)
+        if token:
+            _token_memo[key] = (token, time.monotonic() + TOKEN_EXPIRY_MARGIN)
+        return token
+
+    def _fetch_access_token(self) -> Optional[str]:
+        """Request a new OAuth access token and cache it"""
         try:
-            # Create authorization string
-            auth_string = f"{self.consumer_key}:{self.consumer_secret}"
-            auth_bytes = auth_string.encode('ascii')
-            auth_b64 = base64.b64encode(auth_bytes).decode('ascii')
-
-            # Make request
             url = f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials"
             headers = {
-                'Authorization': f'Basic {auth_b64}',
+                'Authorization': f'Basic {self._basic_auth}',
                 'Content-Type': 'application/json'
             }
 
-            response = requests.get(url, headers=headers, timeout=30)
+            response = _session.get(url, headers=headers, timeout=DARAJA_TIMEOUT)
             response.raise_for_status()
 
-            data = response.json()
-            return data.get('access_token')
+            data = orjson.loads(response.content)
+            access_token = data.get('access_token')
+            if access_token:
+                expires_in = int(data.get('expires_in', 3599))
+                cache.set(
+                    self.token_cache_key,
+                    access_token,
+                    timeout=max(expires_in - TOKEN_EXPIRY_MARGIN, 1)
+                )
+                _token_memo[self.token_cache_key] = (
+                    access_token, time.monotonic() + min(TOKEN_EXPIRY_MARGIN, expires_in)
+                )
+            return access_token
 
         except requests.RequestException as e:
             logger.error(f"Failed to get M-Pesa access token: {e}")
@@ -53,40 +256,54 @@ class MpesaService:
             logger.error(f"Unexpected error getting access token: {e}")
             return None
 
+    def _authorized_post(self, url: str, payload: Dict,
+                         session: requests.Session = _session) -> Optional[requests.Response]:
+        """
+        POST to Daraja with a bearer token, refreshing the cached token once
+        if it has been rejected. Returns None when no token can be obtained.
+        Requests are throttled to the shortcode's per-second quota
+        """
+        response = None
+        for refresh in (False, True):
+            access_token = self.get_access_token(refresh=refresh)
+            if not access_token:
+                return None
+            _acquire_daraja_slot(self.rate_limit)
+
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+            response = session.post(
+                url, data=orjson.dumps(payload), headers=headers, timeout=DARAJA_TIMEOUT
+            )
+            if response.status_code != 401:
+                break
+        return response
+
     def generate_password(self) -> Tuple[str, str]:
         """Generate password and timestamp for STK push"""
-        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-        data_to_encode = f"{self.shortcode}{self.passkey}{timestamp}"
-        password = base64.b64encode(data_to_encode.encode()).decode('utf-8')
+        timestamp = time.strftime('%Y%m%d%H%M%S', time.gmtime(time.time() + DARAJA_UTC_OFFSET))
+        password = base64.b64encode(self._password_prefix + timestamp.encode()).decode('ascii')
         return password, timestamp
 
     def initiate_stk_push(self, phone_number: str, amount: float,
                          account_reference: str, transaction_desc: str) -> Dict:
         """Initiate STK push payment request"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
+            # Format phone number (ensure it starts with 254)
+            match = _PHONE_RE.match(phone_number)
+            if not match:
                 return {
                     'success': False,
-                    'message': 'Failed to get access token'
+                    'message': 'Invalid phone number'
                 }
-
-            # Format phone number (ensure it starts with 254)
-            if phone_number.startswith('0'):
-                phone_number = '254' + phone_number[1:]
-            elif phone_number.startswith('+254'):
-                phone_number = phone_number[1:]
-            elif not phone_number.startswith('254'):
-                phone_number = '254' + phone_number
+            phone_number = '254' + match.group(1)
 
             password, timestamp = self.generate_password()
 
             # Prepare request data
             url = f"{self.base_url}/mpesa/stkpush/v1/processrequest"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
 
             payload = {
                 'BusinessShortCode': self.shortcode,
@@ -102,8 +319,13 @@ class MpesaService:
                 'TransactionDesc': transaction_desc
             }
 
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response_data = response.json()
+            response = self._authorized_post(url, payload, session=_push_session)
+            if response is None:
+                return {
+                    'success': False,
+                    'message': 'Failed to get access token'
+                }
+            response_data = orjson.loads(response.content)
 
             if response.status_code == 200 and response_data.get('ResponseCode') == '0':
                 return {
@@ -140,20 +362,9 @@ class MpesaService:
     def query_stk_status(self, checkout_request_id: str) -> Dict:
         """Query the status of an STK push transaction"""
         try:
-            access_token = self.get_access_token()
-            if not access_token:
-                return {
-                    'success': False,
-                    'message': 'Failed to get access token'
-                }
-
             password, timestamp = self.generate_password()
 
             url = f"{self.base_url}/mpesa/stkpushquery/v1/query"
-            headers = {
-                'Authorization': f'Bearer {access_token}',
-                'Content-Type': 'application/json'
-            }
 
             payload = {
                 'BusinessShortCode': self.shortcode,
@@ -162,8 +373,13 @@ class MpesaService:
                 'CheckoutRequestID': checkout_request_id
             }
 
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response_data = response.json()
+            response = self._authorized_post(url, payload)
+            if response is None:
+                return {
+                    'success': False,
+                    'message': 'Failed to get access token'
+                }
+            response_data = orjson.loads(response.content)
 
             return {
                 'success': response.status_code == 200,
@@ -183,6 +399,27 @@ class MpesaService:
                 'message': f'Unexpected error: {str(e)}'
             }
 
+    @staticmethod
+    def payment_status_for(result_code) -> Optional[str]:
+        """Payment status for an STK result code, or None while there is no result yet"""
+        if result_code is None or result_code == '':
+            return None
+        return STK_RESULT_STATUSES.get(str(result_code), 'failed')
+
+    def query_stk_statuses(self, checkout_request_ids: Iterable[str]) -> Dict[str, Dict]:
+        """
+        Query several STK push transactions concurrently over the shared
+        session, returning each query_stk_status result by checkout request id
+        """
+        checkout_request_ids = list(dict.fromkeys(checkout_request_ids))
+        if not checkout_request_ids:
+            return {}
+
+        workers = min(STK_QUERY_WORKERS, len(checkout_request_ids))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(self.query_stk_status, checkout_request_ids)
+            return dict(zip(checkout_request_ids, results))
+
     def process_callback(self, callback_data: Dict) -> Dict:
         """Process M-Pesa callback data"""
         try:
@@ -207,27 +444,12 @@ class MpesaService:
             }
 
             # Parse metadata items
+            metadata = processed_data['metadata']
             for item in metadata_items:
-                name = item.get('Name')
-                value = item.get('Value')
-
-                if name == 'Amount':
-                    processed_data['metadata']['amount'] = float(value)
-                elif name == 'MpesaReceiptNumber':
-                    processed_data['metadata']['mpesa_receipt_number'] = value
-                elif name == 'TransactionDate':
-                    # Convert timestamp to datetime
-                    if value:
-                        try:
-                            processed_data['metadata']['transaction_date'] = datetime.fromtimestamp(
-                                int(value), tz=timezone.utc
-                            )
-                        except (ValueError, TypeError):
-                            processed_data['metadata']['transaction_date'] = None
-                elif name == 'PhoneNumber':
-                    processed_data['metadata']['phone_number'] = value
-                elif name == 'Balance':
-                    processed_data['metadata']['balance'] = float(value) if value else None
+                parser = CALLBACK_METADATA_PARSERS.get(item.get('Name'))
+                if parser:
+                    key, convert = parser
+                    metadata[key] = convert(item.get('Value'))
 
             return processed_data
 
@@ -240,37 +462,18 @@ class MpesaService:
 
     def validate_callback_ip(self, request_ip: str) -> bool:
         """Validate that callback is coming from M-Pesa servers"""
-        # M-Pesa callback IP ranges (update as needed)
-        allowed_ips = [
-            '196.201.214.200',
-            '196.201.214.206',
-            '196.201.213.114',
-            '196.201.214.207',
-            '196.201.214.208',
-            '196.201.213.44',
-            '196.201.212.127',
-            '196.201.212.138',
-            '196.201.212.129',
-            '196.201.212.136',
-            '196.201.212.74'
-        ]
-
-        # For sandbox, allow localhost and common development IPs
-        if self.environment == 'sandbox':
-            allowed_ips.extend([
-                '127.0.0.1',
-                '::1',
-                '0.0.0.0'
-            ])
-
+        allowed_ips = (
+            MPESA_SANDBOX_CALLBACK_IPS if self.environment == 'sandbox'
+            else MPESA_CALLBACK_IPS
+        )
         return request_ip in allowed_ips
 
 
 class PaymentProcessingService:
     """Service for processing payments and managing escrow"""
 
-    def __init__(self):
-        self.mpesa_service = MpesaService()
+    def __init__(self, mpesa_service: Optional[MpesaService] = None):
+        self.mpesa_service = mpesa_service or MpesaService()
 
     def initiate_payment(self, payment_obj, phone_number: str = None) -> Dict:
         """Initiate payment based on payment method"""
@@ -318,7 +521,7 @@ class PaymentProcessingService:
         result = self.mpesa_service.initiate_stk_push(
             phone_number=phone_number,
             amount=float(payment_obj.amount),
-            account_reference=payment_obj.payment_id,
+            account_reference=payment_obj.reference,
             transaction_desc=f"Payment for order {payment_obj.order.order_id}"
         )
 
@@ -349,7 +552,7 @@ class PaymentProcessingService:
                 'account_number': '1234567890',
                 'bank_name': 'Equity Bank',
                 'branch': 'Kisii Branch',
-                'reference': payment_obj.payment_id
+                'reference': payment_obj.reference
             }
         }
 
@@ -426,4 +629,10 @@ class PaymentProcessingService:
             return {
                 'success': False,
                 'message': f'Failed to release escrow funds: {str(e)}'
-            }
\ No newline at end of file
+            }
+
+
+# Shared per-process instances so settings are read once and every caller
+# draws on the same pooled Daraja session
+mpesa_service = MpesaService()
+payment_service = PaymentProcessingService(mpesa_service)
@@ -1,16 +1,35 @@
 from celery import shared_task
+from django.db import transaction as db_transaction
 from django.utils import timezone
-from django.db.models import Sum, Count, Q
+from django.db.models import DurationField, ExpressionWrapper, F
 from datetime import datetime, timedelta
+from itertools import islice
 from .models import (
-    Payment, EscrowAccount, PaymentAnalytics,
-    PaymentWebhook, MpesaTransaction
+    Payment, EscrowAccount, PaymentWebhook, MpesaTransaction
 )
-from .services import PaymentProcessingService, MpesaService
+from orders.models import Order
+from .services import mpesa_service, payment_service
+from .utils import PaymentAnalyticsCalculator
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Rows streamed and written back per round by the batch tasks
+TASK_BATCH_SIZE = 500
+
+# Callbacks younger than this are left to their own process_mpesa_callback
+# retries, which back off for roughly half a minute, before the sweep takes over
+WEBHOOK_SWEEP_GRACE = timedelta(minutes=2)
+
+# Days re-aggregated by the nightly analytics rollup. Cash and bank payments
+# complete after the day they were created, so recent days are refreshed
+# rather than frozen at their first rollup
+ANALYTICS_RECOMPUTE_DAYS = 30
+
+# Processed webhook payloads are compressed after this many days
+WEBHOOK_ARCHIVE_DAYS = 7
+WEBHOOK_PURGE_BATCH_SIZE = 5000
+
 
 @shared_task
 def auto_release_escrow_funds():
@@ -21,32 +40,32 @@ def auto_release_escrow_funds():
     try:
         now = timezone.now()
 
-        # Find escrow accounts eligible for auto-release
-        eligible_escrows = EscrowAccount.objects.filter(
+        # Find escrow accounts eligible for auto-release: held for at least
+        # their own auto_release_days with the payment still completed
+        eligible_escrows = EscrowAccount.objects.annotate(
+            held_for=ExpressionWrapper(now - F('created_at'), output_field=DurationField())
+        ).filter(
             status='active',
-            created_at__lte=now - timedelta(days=7)  # Default 7 days
-        ).select_related('payment', 'seller')
+            payment__status='completed',
+            held_for__gte=ExpressionWrapper(
+                F('auto_release_days') * timedelta(days=1), output_field=DurationField()
+            )
+        ).only('id', 'created_at')
 
         released_count = 0
-        processing_service = PaymentProcessingService()
 
-        for escrow in eligible_escrows:
-            # Check if enough days have passed
+        for escrow in eligible_escrows.iterator(chunk_size=TASK_BATCH_SIZE):
             days_held = (now - escrow.created_at).days
-            if days_held >= escrow.auto_release_days:
+            result = payment_service.release_escrow_funds(
+                str(escrow.id),
+                release_reason='Auto-released after {} days'.format(days_held)
+            )
 
-                # Verify payment is still completed
-                if escrow.payment.status == 'completed':
-                    result = processing_service.release_escrow_funds(
-                        str(escrow.id),
-                        release_reason='Auto-released after {} days'.format(days_held)
-                    )
-
-                    if result['success']:
-                        released_count += 1
-                        logger.info(f"Auto-released escrow {escrow.id} after {days_held} days")
-                    else:
-                        logger.error(f"Failed to auto-release escrow {escrow.id}: {result['message']}")
+            if result['success']:
+                released_count += 1
+                logger.info(f"Auto-released escrow {escrow.id} after {days_held} days")
+            else:
+                logger.error(f"Failed to auto-release escrow {escrow.id}: {result['message']}")
 
         logger.info(f"Auto-release task completed. Released {released_count} escrow accounts.")
         return {'released_count': released_count}
@@ -60,77 +79,19 @@ def auto_release_escrow_funds():
 def generate_daily_payment_analytics():
     """
     Generate daily payment analytics
-    Runs daily to aggregate payment data
+    Runs daily, re-aggregating the trailing ANALYTICS_RECOMPUTE_DAYS up to yesterday
     """
     try:
-        yesterday = timezone.now().date() - timedelta(days=1)
-
-        # Check if analytics already exist for yesterday
-        analytics, created = PaymentAnalytics.objects.get_or_create(
-            date=yesterday,
-            defaults={
-                'total_transactions': 0,
-                'successful_transactions': 0,
-                'failed_transactions': 0,
-                'total_amount': 0,
-                'total_fees_collected': 0,
-                'mpesa_transactions': 0,
-                'mpesa_amount': 0,
-                'amount_in_escrow': 0,
-                'escrow_releases': 0,
-            }
-        )
-
-        if not created:
-            logger.info(f"Analytics for {yesterday} already exist, updating...")
-
-        # Calculate payment metrics for yesterday
-        yesterday_payments = Payment.objects.filter(
-            created_at__date=yesterday
-        )
-
-        analytics.total_transactions = yesterday_payments.count()
-        analytics.successful_transactions = yesterday_payments.filter(
-            status__in=['completed', 'paid']
-        ).count()
-        analytics.failed_transactions = yesterday_payments.filter(
-            status='failed'
-        ).count()
-
-        # Calculate amounts
-        completed_payments = yesterday_payments.filter(status__in=['completed', 'paid'])
-        analytics.total_amount = completed_payments.aggregate(
-            total=Sum('amount')
-        )['total'] or 0
-
-        # Calculate platform fees (3% default)
-        analytics.total_fees_collected = analytics.total_amount * 0.03
-
-        # M-Pesa specific metrics
-        mpesa_payments = completed_payments.filter(payment_method='mpesa')
-        analytics.mpesa_transactions = mpesa_payments.count()
-        analytics.mpesa_amount = mpesa_payments.aggregate(
-            total=Sum('amount')
-        )['total'] or 0
-
-        # Escrow metrics
-        analytics.amount_in_escrow = EscrowAccount.objects.filter(
-            status='active',
-            created_at__date=yesterday
-        ).aggregate(total=Sum('amount'))['total'] or 0
-
-        analytics.escrow_releases = EscrowAccount.objects.filter(
-            status='released',
-            release_date__date=yesterday
-        ).count()
+        yesterday = timezone.localdate() - timedelta(days=1)
+        for days_back in range(ANALYTICS_RECOMPUTE_DAYS - 1, -1, -1):
+            metrics = PaymentAnalyticsCalculator.rollup_day(yesterday - timedelta(days=days_back))
 
-        analytics.save()
-
-        logger.info(f"Generated analytics for {yesterday}: {analytics.total_transactions} transactions")
+        logger.info(f"Generated analytics for {yesterday}: {metrics['total_transactions']} transactions")
         return {
             'date': str(yesterday),
-            'total_transactions': analytics.total_transactions,
-            'total_amount': float(analytics.total_amount)
+            'days_recomputed': ANALYTICS_RECOMPUTE_DAYS,
+            'total_transactions': metrics['total_transactions'],
+            'total_amount': float(metrics['total_amount'])
         }
 
     except Exception as e:
@@ -138,6 +99,13 @@ def generate_daily_payment_analytics():
         return {'error': str(e)}
 
 
+def _chunked(iterable, size):
+    """Yield successive lists of up to ``size`` items from ``iterable``"""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
 @shared_task
 def process_pending_webhooks():
     """
@@ -145,59 +113,19 @@ def process_pending_webhooks():
     Runs periodically to handle failed webhook processing
     """
     try:
+        now = timezone.now()
         pending_webhooks = PaymentWebhook.objects.filter(
             processed=False,
             processing_error__isnull=True,
-            created_at__gte=timezone.now() - timedelta(hours=24)  # Only last 24 hours
-        )
+            created_at__gte=now - timedelta(hours=24),  # Only last 24 hours
+            created_at__lt=now - WEBHOOK_SWEEP_GRACE
+        ).only(
+            'id', 'webhook_type', 'raw_data', 'payment', 'processed', 'processing_error'
+        ).iterator(chunk_size=TASK_BATCH_SIZE)
 
         processed_count = 0
-        mpesa_service = MpesaService()
-
-        for webhook in pending_webhooks:
-            try:
-                if webhook.webhook_type == 'mpesa_callback':
-                    # Reprocess M-Pesa callback
-                    processed_data = mpesa_service.process_callback(webhook.raw_data)
-
-                    if 'checkout_request_id' in processed_data:
-                        mpesa_transaction = MpesaTransaction.objects.filter(
-                            checkout_request_id=processed_data['checkout_request_id']
-                        ).first()
-
-                        if mpesa_transaction:
-                            # Update transaction and payment status
-                            mpesa_transaction.result_code = processed_data.get('result_code')
-                            mpesa_transaction.result_desc = processed_data.get('result_desc')
-
-                            if processed_data['success']:
-                                metadata = processed_data.get('metadata', {})
-                                mpesa_transaction.mpesa_receipt_number = metadata.get('mpesa_receipt_number')
-                                mpesa_transaction.transaction_date = metadata.get('transaction_date')
-                                mpesa_transaction.save()
-
-                                payment = mpesa_transaction.payment
-                                payment.status = 'completed'
-                                payment.payment_date = timezone.now()
-                                payment.external_transaction_id = metadata.get('mpesa_receipt_number')
-                                payment.save()
-
-                                if payment.order:
-                                    payment.order.payment_status = 'paid'
-                                    payment.order.save()
-
-                            webhook.payment = mpesa_transaction.payment
-                            webhook.processed = True
-                            webhook.save()
-                            processed_count += 1
-                        else:
-                            webhook.processing_error = "M-Pesa transaction not found"
-                            webhook.save()
-
-            except Exception as e:
-                webhook.processing_error = str(e)
-                webhook.save()
-                logger.error(f"Error processing webhook {webhook.id}: {e}")
+        for webhooks in _chunked(pending_webhooks, TASK_BATCH_SIZE):
+            processed_count += _process_webhook_batch(webhooks, mpesa_service)
 
         logger.info(f"Processed {processed_count} pending webhooks")
         return {'processed_count': processed_count}
@@ -207,6 +135,169 @@ def process_pending_webhooks():
         return {'error': str(e)}
 
 
+def _process_webhook_batch(webhooks, mpesa_service):
+    """Apply a batch of stored M-Pesa callbacks and return how many were processed"""
+    now = timezone.now()
+
+    # Parse every callback first so the transactions load in one query
+    parsed = []
+    for webhook in webhooks:
+        if webhook.webhook_type != 'mpesa_callback':
+            continue
+        try:
+            processed_data = mpesa_service.process_callback(webhook.raw_data)
+        except Exception as e:
+            webhook.processing_error = str(e)
+            parsed.append((webhook, None))
+            logger.error(f"Error processing webhook {webhook.id}: {e}")
+            continue
+        if 'checkout_request_id' in processed_data:
+            parsed.append((webhook, processed_data))
+
+    transactions = {
+        mpesa_transaction.checkout_request_id: mpesa_transaction
+        for mpesa_transaction in MpesaTransaction.objects.filter(
+            checkout_request_id__in=[data['checkout_request_id'] for _, data in parsed if data]
+        ).select_related('payment')
+    }
+
+    webhooks_to_update = []
+    transactions_to_update = []
+    payments_to_update = []
+    paid_order_ids = []
+    processed_count = 0
+
+    for webhook, processed_data in parsed:
+        webhook.updated_at = now
+        webhooks_to_update.append(webhook)
+        if processed_data is None:
+            continue
+
+        mpesa_transaction = transactions.get(processed_data['checkout_request_id'])
+        if not mpesa_transaction:
+            webhook.processing_error = "M-Pesa transaction not found"
+            continue
+
+        # Update transaction and payment status
+        mpesa_transaction.result_code = processed_data.get('result_code')
+        mpesa_transaction.result_desc = processed_data.get('result_desc')
+        mpesa_transaction.updated_at = now
+
+        if processed_data['success']:
+            metadata = processed_data.get('metadata', {})
+            mpesa_transaction.mpesa_receipt_number = metadata.get('mpesa_receipt_number')
+            mpesa_transaction.transaction_date = metadata.get('transaction_date')
+
+            payment = mpesa_transaction.payment
+            payment.status = 'completed'
+            payment.payment_date = now
+            payment.external_transaction_id = metadata.get('mpesa_receipt_number')
+            payment.updated_at = now
+            payments_to_update.append(payment)
+            paid_order_ids.append(payment.order_id)
+
+        transactions_to_update.append(mpesa_transaction)
+        webhook.payment_id = mpesa_transaction.payment_id
+        webhook.processed = True
+        processed_count += 1
+
+    with db_transaction.atomic():
+        MpesaTransaction.objects.bulk_update(transactions_to_update, [
+            'result_code', 'result_desc', 'mpesa_receipt_number',
+            'transaction_date', 'updated_at'
+        ])
+        Payment.objects.bulk_update(payments_to_update, [
+            'status', 'payment_date', 'external_transaction_id', 'updated_at'
+        ])
+        if paid_order_ids:
+            Order.objects.filter(pk__in=paid_order_ids).update(
+                payment_status='paid', updated_at=now
+            )
+        PaymentWebhook.objects.bulk_update(webhooks_to_update, [
+            'payment', 'processed', 'processing_error', 'updated_at'
+        ])
+
+    return processed_count
+
+
+@shared_task(
+    autoretry_for=(MpesaTransaction.DoesNotExist,),
+    retry_backoff=True,
+    max_retries=5
+)
+def process_mpesa_callback(webhook_id):
+    """
+    Apply a stored M-Pesa callback to its transaction, payment and order
+    Queued by the callback view so Daraja is acknowledged before any lookups
+    """
+    try:
+        with db_transaction.atomic():
+            # Lock the webhook so redelivered callbacks are applied once
+            webhook = PaymentWebhook.objects.select_for_update().only(
+                'id', 'raw_data', 'processed'
+            ).get(pk=webhook_id)
+            if webhook.processed:
+                return {'processed': False}
+
+            processed_data = mpesa_service.process_callback(webhook.raw_data)
+            if 'checkout_request_id' not in processed_data:
+                return {'processed': False}
+
+            # The callback can beat the STK push commit; DoesNotExist is retried
+            # with backoff and process_pending_webhooks sweeps up what is left
+            mpesa_transaction = MpesaTransaction.objects.values(
+                'pk', 'payment_id', 'payment__order_id'
+            ).get(checkout_request_id=processed_data['checkout_request_id'])
+            payment_id = mpesa_transaction['payment_id']
+            now = timezone.now()
+
+            # Write only the changed columns, one UPDATE per row and no reloads
+            transaction_fields = {
+                'result_code': processed_data.get('result_code'),
+                'result_desc': processed_data.get('result_desc'),
+            }
+
+            if processed_data['success']:
+                metadata = processed_data.get('metadata', {})
+                transaction_fields['mpesa_receipt_number'] = metadata.get('mpesa_receipt_number')
+                transaction_fields['transaction_date'] = metadata.get('transaction_date')
+                payment_fields = {
+                    'status': 'completed',
+                    'payment_date': now,
+                    'external_transaction_id': metadata.get('mpesa_receipt_number'),
+                }
+            else:
+                payment_fields = {
+                    'status': 'failed',
+                    'failure_reason': processed_data.get('result_desc'),
+                }
+
+            MpesaTransaction.objects.filter(pk=mpesa_transaction['pk']).update(
+                updated_at=now, **transaction_fields
+            )
+            Payment.objects.filter(pk=payment_id).update(updated_at=now, **payment_fields)
+
+            if processed_data['success']:
+                Order.objects.filter(pk=mpesa_transaction['payment__order_id']).update(
+                    payment_status='paid', updated_at=now
+                )
+
+            PaymentWebhook.objects.filter(pk=webhook.pk).update(
+                payment_id=payment_id, processed=True, updated_at=now
+            )
+
+        return {'processed': True, 'payment_id': str(payment_id)}
+
+    except MpesaTransaction.DoesNotExist:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing M-Pesa callback {webhook_id}: {e}")
+        PaymentWebhook.objects.filter(pk=webhook_id).update(
+            processing_error=str(e), updated_at=timezone.now()
+        )
+        return {'error': str(e)}
+
+
 @shared_task
 def sync_mpesa_transaction_status():
     """
@@ -219,36 +310,11 @@ def sync_mpesa_transaction_status():
             payment__status='processing',
             checkout_request_id__isnull=False,
             created_at__gte=timezone.now() - timedelta(hours=1)  # Only recent ones
-        ).select_related('payment')
+        ).select_related('payment').iterator(chunk_size=TASK_BATCH_SIZE)
 
         updated_count = 0
-        mpesa_service = MpesaService()
-
-        for transaction in pending_transactions:
-            try:
-                result = mpesa_service.query_stk_status(transaction.checkout_request_id)
-
-                if result['success']:
-                    data = result['data']
-                    transaction.result_code = data.get('ResultCode')
-                    transaction.result_desc = data.get('ResultDesc')
-                    transaction.save()
-
-                    # Update payment status based on result
-                    if data.get('ResultCode') == '0':  # Success
-                        transaction.payment.status = 'completed'
-                        transaction.payment.payment_date = timezone.now()
-                    elif data.get('ResultCode') in ['1032', '1037']:  # User cancelled or timeout
-                        transaction.payment.status = 'cancelled'
-                    elif data.get('ResultCode'):  # Other error codes
-                        transaction.payment.status = 'failed'
-                        transaction.payment.failure_reason = data.get('ResultDesc')
-
-                    transaction.payment.save()
-                    updated_count += 1
-
-            except Exception as e:
-                logger.error(f"Error syncing M-Pesa transaction {transaction.id}: {e}")
+        for transactions in _chunked(pending_transactions, TASK_BATCH_SIZE):
+            updated_count += _sync_transaction_batch(transactions, mpesa_service)
 
         logger.info(f"Synced {updated_count} M-Pesa transaction statuses")
         return {'updated_count': updated_count}
@@ -258,6 +324,53 @@ def sync_mpesa_transaction_status():
         return {'error': str(e)}
 
 
+def _sync_transaction_batch(transactions, mpesa_service):
+    """Query and write back a batch of M-Pesa transactions, returning how many changed"""
+    now = timezone.now()
+    transactions_to_update = []
+
+    # Daraja is queried concurrently; the results are applied in order
+    results = mpesa_service.query_stk_statuses(
+        transaction.checkout_request_id for transaction in transactions
+    )
+
+    for transaction in transactions:
+        try:
+            result = results[transaction.checkout_request_id]
+
+            if result['success']:
+                data = result['data']
+                transaction.result_code = data.get('ResultCode')
+                transaction.result_desc = data.get('ResultDesc')
+                transaction.updated_at = now
+
+                # Update payment status based on result
+                new_status = mpesa_service.payment_status_for(data.get('ResultCode'))
+                if new_status:
+                    transaction.payment.status = new_status
+                if new_status == 'completed':
+                    transaction.payment.payment_date = now
+                elif new_status == 'failed':
+                    transaction.payment.failure_reason = data.get('ResultDesc')
+                transaction.payment.updated_at = now
+
+                transactions_to_update.append(transaction)
+
+        except Exception as e:
+            logger.error(f"Error syncing M-Pesa transaction {transaction.id}: {e}")
+
+    with db_transaction.atomic():
+        MpesaTransaction.objects.bulk_update(
+            transactions_to_update, ['result_code', 'result_desc', 'updated_at']
+        )
+        Payment.objects.bulk_update(
+            [transaction.payment for transaction in transactions_to_update],
+            ['status', 'payment_date', 'failure_reason', 'updated_at']
+        )
+
+    return len(transactions_to_update)
+
+
 @shared_task
 def cleanup_old_webhooks():
     """
@@ -269,10 +382,17 @@ def cleanup_old_webhooks():
 
         old_webhooks = PaymentWebhook.objects.filter(
             created_at__lt=cutoff_date
-        )
-
-        deleted_count = old_webhooks.count()
-        old_webhooks.delete()
+        ).values_list('pk', flat=True)
+
+        # Webhooks have no dependents, so each delete() is a single DELETE;
+        # purging in slices keeps every statement and its locks short
+        deleted_count = 0
+        while True:
+            webhook_ids = list(old_webhooks[:WEBHOOK_PURGE_BATCH_SIZE])
+            if not webhook_ids:
+                break
+            deleted, _ = PaymentWebhook.objects.filter(pk__in=webhook_ids).delete()
+            deleted_count += deleted
 
         logger.info(f"Cleaned up {deleted_count} old webhook records")
         return {'deleted_count': deleted_count}
@@ -282,6 +402,36 @@ def cleanup_old_webhooks():
         return {'error': str(e)}
 
 
+@shared_task
+def archive_processed_webhooks():
+    """
+    Compress the payloads of processed webhooks
+    Keeps recent rows readable as JSON and shrinks the rest until cleanup
+    """
+    try:
+        cutoff_date = timezone.now() - timedelta(days=WEBHOOK_ARCHIVE_DAYS)
+
+        webhooks = PaymentWebhook.objects.filter(
+            processed=True,
+            raw_data__isnull=False,
+            created_at__lt=cutoff_date
+        ).only('id', 'raw_data')
+
+        archived_count = 0
+        for batch in _chunked(webhooks.iterator(chunk_size=TASK_BATCH_SIZE), TASK_BATCH_SIZE):
+            for webhook in batch:
+                webhook.archive_payload()
+            PaymentWebhook.objects.bulk_update(batch, ['raw_data', 'raw_data_compressed'])
+            archived_count += len(batch)
+
+        logger.info(f"Archived {archived_count} webhook payloads")
+        return {'archived_count': archived_count}
+
+    except Exception as e:
+        logger.error(f"Error in archive_processed_webhooks task: {e}")
+        return {'error': str(e)}
+
+
 @shared_task
 def send_payment_notifications(payment_id, event_type):
     """
@@ -289,10 +439,16 @@ def send_payment_notifications(payment_id, event_type):
     Called when payment status changes
     """
     try:
-        payment = Payment.objects.get(id=payment_id)
+        # Only the public reference is needed, so skip building the model
+        reference = Payment.objects.filter(id=payment_id).values_list(
+            'payment_id', flat=True
+        ).first()
+        if reference is None:
+            logger.error(f"Payment {payment_id} not found for notification")
+            return {'error': 'Payment not found'}
 
         # This will be enhanced when notifications app is implemented
-        logger.info(f"Payment {payment.payment_id} - {event_type}")
+        logger.info(f"Payment {reference} - {event_type}")
 
         # Placeholder for notification logic
         notifications_sent = 0
@@ -309,14 +465,11 @@ def send_payment_notifications(payment_id, event_type):
             notifications_sent = 1
 
         return {
-            'payment_id': payment.payment_id,
+            'payment_id': reference,
             'event_type': event_type,
             'notifications_sent': notifications_sent
         }
 
-    except Payment.DoesNotExist:
-        logger.error(f"Payment {payment_id} not found for notification")
-        return {'error': 'Payment not found'}
     except Exception as e:
         logger.error(f"Error sending payment notifications: {e}")
         return {'error': str(e)}
\ No newline at end of file
@@ -1,16 +1,42 @@
-from django.test import TestCase
+import base64
+import orjson
+import requests
+import uuid
+from io import BytesIO, StringIO
+from django.core.management import call_command
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 from django.urls import reverse
 from rest_framework.test import APITestCase
 from rest_framework import status
+from datetime import date, datetime, timedelta
 from decimal import Decimal
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch
+from urllib3 import HTTPResponse
 from .models import (
     Payment, MpesaTransaction, EscrowAccount,
-    PaymentWebhook, PaymentRefund
+    PaymentWebhook, PaymentRefund, PaymentAnalytics
 )
-from .services import MpesaService, PaymentProcessingService
-from .utils import EscrowManager, validate_payment_amount, format_mpesa_phone_number
+from .serializers import PaymentRefundCreateSerializer
+from .services import (
+    DARAJA_PUSH_RETRY, DARAJA_RETRY, DARAJA_TIMEOUT, MpesaService, PaymentProcessingService,
+    _acquire_daraja_slot, _push_session, _session, _token_memo
+)
+from .tasks import (
+    ANALYTICS_RECOMPUTE_DAYS, WEBHOOK_ARCHIVE_DAYS, WEBHOOK_SWEEP_GRACE,
+    archive_processed_webhooks, auto_release_escrow_funds, cleanup_old_webhooks,
+    generate_daily_payment_analytics, process_mpesa_callback, process_pending_webhooks,
+    send_payment_notifications, sync_mpesa_transaction_status
+)
+from .utils import (
+    EscrowManager, PaymentAnalyticsCalculator, validate_payment_amount,
+    format_mpesa_phone_number
+)
+from core.utils import ULID_ALPHABET, generate_ulid
 from orders.models import Order, OrderItem
 from products.models import Product, ProductCategory
 from users.models import FarmerProfile
@@ -18,53 +44,62 @@ from users.models import FarmerProfile
 User = get_user_model()
 
 
+def daraja_response(body=None, status_code=200):
+    """Build a real requests.Response carrying a canned Daraja JSON body"""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = orjson.dumps(body or {})
+    return response
+
+
 class PaymentModelTests(TestCase):
     """Test payment models"""
 
-    def setUp(self):
-        self.user = User.objects.create_user(
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
             email='test@example.com',
+            username='test',
             password='testpass123',
             role='buyer'
         )
 
         # Create a farmer
-        self.farmer = User.objects.create_user(
+        cls.farmer = User.objects.create_user(
             email='farmer@example.com',
+            username='farmer',
             password='testpass123',
             role='farmer'
         )
 
         # Create farmer profile
-        self.farmer_profile = FarmerProfile.objects.create(
-            user=self.farmer,
+        cls.farmer_profile = FarmerProfile.objects.create(
+            user=cls.farmer,
             farm_name='Test Farm',
-            farm_size_acres=10.0,
-            county='Kisii',
-            sub_county='Nyaribari Masaba'
+            farm_size=Decimal('10.00')
         )
 
         # Create product category
-        self.category = ProductCategory.objects.create(
+        cls.category = ProductCategory.objects.create(
             name='Vegetables',
             description='Fresh vegetables'
         )
 
         # Create product
-        self.product = Product.objects.create(
-            farmer=self.farmer,
-            category=self.category,
+        cls.product = Product.objects.create(
+            farmer=cls.farmer,
+            category=cls.category,
             name='Tomatoes',
             description='Fresh tomatoes',
             price_per_unit=Decimal('50.00'),
             unit='kg',
-            available_quantity=100,
+            quantity_available=Decimal('100.00'),
             county='Kisii'
         )
 
         # Create order
-        self.order = Order.objects.create(
-            buyer=self.user,
+        cls.order = Order.objects.create(
+            buyer=cls.user,
             subtotal=Decimal('500.00'),
             delivery_fee=Decimal('100.00'),
             platform_fee=Decimal('18.00'),
@@ -75,11 +110,11 @@ class PaymentModelTests(TestCase):
         )
 
         # Create order item
-        self.order_item = OrderItem.objects.create(
-            order=self.order,
-            product=self.product,
+        cls.order_item = OrderItem.objects.create(
+            order=cls.order,
+            product=cls.product,
             quantity=10,
-            price_per_unit=Decimal('50.00')
+            unit_price=Decimal('50.00')
         )
 
     def test_payment_creation(self):
@@ -95,7 +130,24 @@ class PaymentModelTests(TestCase):
         self.assertEqual(payment.amount, Decimal('618.00'))
         self.assertEqual(payment.status, 'pending')
         self.assertEqual(payment.currency, 'KES')
-        self.assertTrue(payment.payment_id.startswith('TXN'))
+        self.assertEqual(len(payment.payment_id), 26)
+        self.assertEqual(len(payment.reference), 12)
+        self.assertTrue(payment.payment_id.endswith(payment.reference))
+
+    @patch('payments.services.MpesaService.initiate_stk_push')
+    def test_stk_push_uses_short_account_reference(self, mock_push):
+        """Test the ULID is shortened to Daraja's 12-character AccountReference"""
+        mock_push.return_value = {'success': False, 'message': 'Declined'}
+        payment = Payment.objects.create(
+            order=self.order,
+            payer=self.user,
+            amount=Decimal('618.00'),
+            payment_method='mpesa'
+        )
+
+        PaymentProcessingService(MpesaService()).initiate_payment(payment, '254712345678')
+
+        self.assertEqual(mock_push.call_args.kwargs['account_reference'], payment.reference)
 
     def test_mpesa_transaction_creation(self):
         """Test M-Pesa transaction creation"""
@@ -137,25 +189,315 @@ class PaymentModelTests(TestCase):
         self.assertEqual(escrow.status, 'active')
         self.assertEqual(escrow.auto_release_days, 7)
 
+    def test_create_escrow_for_order(self):
+        """Test escrow is sized by the seller's share of the order"""
+        payment = Payment.objects.create(
+            order=self.order,
+            payer=self.user,
+            amount=Decimal('618.00'),
+            payment_method='mpesa'
+        )
+
+        escrow = EscrowManager.create_escrow_for_order(self.order, payment)
+        self.assertEqual(escrow.amount.as_tuple().exponent, -2)
+
+        escrow.refresh_from_db()
+        self.assertEqual(escrow.payment, payment)
+        self.assertEqual(escrow.seller, self.farmer)
+        self.assertEqual(escrow.amount, Decimal('500.00'))
+        self.assertEqual(escrow.status, 'active')
+
+        # A repeated callback returns the existing escrow instead of a duplicate
+        self.assertEqual(EscrowManager.create_escrow_for_order(self.order, payment), escrow)
+        self.assertEqual(EscrowAccount.objects.filter(payment=payment).count(), 1)
+
+    def test_create_escrow_for_multi_seller_order(self):
+        """Test each seller of a multi-vendor order gets their own escrow"""
+        second_farmer = User.objects.create_user(
+            email='farmer2@example.com',
+            username='farmer2',
+            password='testpass123',
+            role='farmer'
+        )
+        onions = Product.objects.create(
+            farmer=second_farmer,
+            category=self.category,
+            name='Onions',
+            description='Red onions',
+            price_per_unit=Decimal('60.00'),
+            unit='kg',
+            quantity_available=Decimal('100.00'),
+            county='Kisii'
+        )
+        order = Order.objects.create(
+            buyer=self.user,
+            subtotal=Decimal('800.00'),
+            delivery_fee=Decimal('100.00'),
+            platform_fee=Decimal('100.00'),
+            total_amount=Decimal('1000.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        OrderItem.objects.create(
+            order=order, product=self.product, quantity=10, unit_price=Decimal('50.00')
+        )
+        OrderItem.objects.create(
+            order=order, product=onions, quantity=5, unit_price=Decimal('60.00')
+        )
+        payment = Payment.objects.create(
+            order=order,
+            payer=self.user,
+            amount=Decimal('1000.00'),
+            payment_method='mpesa'
+        )
+
+        self.assertIsNotNone(EscrowManager.create_escrow_for_order(order, payment))
+        EscrowManager.create_escrow_for_order(order, payment)
+
+        self.assertEqual(
+            dict(payment.escrows.values_list('seller__email', 'amount')),
+            {'farmer@example.com': Decimal('500.00'), 'farmer2@example.com': Decimal('300.00')}
+        )
+
+    def test_create_escrow_for_zero_total_order(self):
+        """Test an order with nothing to split gets no escrow"""
+        order = Order.objects.create(
+            buyer=self.user,
+            subtotal=Decimal('0.00'),
+            delivery_fee=Decimal('0.00'),
+            platform_fee=Decimal('0.00'),
+            total_amount=Decimal('0.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        OrderItem.objects.create(
+            order=order, product=self.product, quantity=1, unit_price=Decimal('0.00')
+        )
+        payment = Payment.objects.create(
+            order=order,
+            payer=self.user,
+            amount=Decimal('0.00'),
+            payment_method='cash'
+        )
+
+        self.assertIsNone(EscrowManager.create_escrow_for_order(order, payment))
+        self.assertFalse(payment.escrows.exists())
+
+    def test_get_escrow_status(self):
+        """Test escrow status loads escrows and sellers in one query"""
+        payment = Payment.objects.create(
+            order=self.order,
+            payer=self.user,
+            amount=Decimal('618.00'),
+            payment_method='mpesa'
+        )
+
+        status = EscrowManager.get_escrow_status(payment.payment_id)
+        self.assertFalse(status['has_escrow'])
+
+        EscrowAccount.objects.create(
+            payment=payment,
+            seller=self.farmer,
+            amount=Decimal('500.00')
+        )
+
+        with self.assertNumQueries(2):
+            status = EscrowManager.get_escrow_status(payment.payment_id)
+
+        self.assertTrue(status['has_escrow'])
+        self.assertEqual(status['total_escrowed'], 500.0)
+        self.assertEqual(status['escrow_accounts'][0]['seller'], 'farmer@example.com')
+
+    def test_release_all_escrow_for_payment(self):
+        """Test active escrows are released and the payment completed"""
+        payment = Payment.objects.create(
+            order=self.order,
+            payer=self.user,
+            amount=Decimal('618.00'),
+            payment_method='mpesa'
+        )
+        escrow = EscrowAccount.objects.create(
+            payment=payment,
+            seller=self.farmer,
+            amount=Decimal('500.00')
+        )
+
+        result = EscrowManager.release_all_escrow_for_payment(payment.payment_id, 'Delivered')
+
+        self.assertTrue(result['success'])
+        self.assertEqual(result['released_count'], 1)
+        self.assertEqual(result['total_released'], 500.0)
+        escrow.refresh_from_db()
+        payment.refresh_from_db()
+        self.assertEqual(escrow.status, 'released')
+        self.assertEqual(escrow.resolution_notes, 'Delivered')
+        self.assertIsNotNone(escrow.release_date)
+        self.assertEqual(payment.status, 'completed')
 
-class MpesaServiceTests(TestCase):
+        result = EscrowManager.release_all_escrow_for_payment(payment.payment_id)
+        self.assertFalse(result['success'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class MpesaServiceTests(SimpleTestCase):
     """Test M-Pesa service integration"""
 
     def setUp(self):
+        cache.clear()
+        _token_memo.clear()
         self.mpesa_service = MpesaService()
 
-    @patch('payments.services.requests.get')
+    @patch('payments.services._session.get')
     def test_get_access_token_success(self, mock_get):
         """Test successful access token retrieval"""
-        mock_response = MagicMock()
-        mock_response.json.return_value = {'access_token': 'test_token_123'}
-        mock_response.raise_for_status.return_value = None
-        mock_get.return_value = mock_response
+        mock_get.return_value = daraja_response({'access_token': 'test_token_123'})
 
         token = self.mpesa_service.get_access_token()
         self.assertEqual(token, 'test_token_123')
 
-    @patch('payments.services.requests.get')
+    @patch('payments.services._session.get')
+    def test_access_token_is_cached(self, mock_get):
+        """Test the token is fetched once and reused until refreshed"""
+        mock_get.return_value = daraja_response({'access_token': 'test_token_123', 'expires_in': '3599'})
+
+        self.assertEqual(self.mpesa_service.get_access_token(), 'test_token_123')
+        self.assertEqual(MpesaService().get_access_token(), 'test_token_123')
+        self.assertEqual(mock_get.call_count, 1)
+
+        mock_get.return_value = daraja_response({'access_token': 'test_token_456', 'expires_in': '3599'})
+        self.assertEqual(self.mpesa_service.get_access_token(refresh=True), 'test_token_456')
+        self.assertEqual(self.mpesa_service.get_access_token(), 'test_token_456')
+
+    @patch('payments.services._session.get')
+    def test_token_is_served_from_process_memo(self, mock_get):
+        """Test a token read from the shared cache is reused without another cache read"""
+        cache.set(self.mpesa_service.token_cache_key, 'shared_token')
+        self.assertEqual(self.mpesa_service.get_access_token(), 'shared_token')
+
+        with patch('payments.services.cache.get') as mock_cache_get:
+            self.assertEqual(MpesaService().get_access_token(), 'shared_token')
+        mock_cache_get.assert_not_called()
+        mock_get.assert_not_called()
+
+    @patch('payments.services._session.post')
+    @patch('payments.services._session.get')
+    def test_rejected_token_is_refreshed_once(self, mock_get, mock_post):
+        """Test a 401 from Daraja refreshes the cached token and retries"""
+        cache.set(self.mpesa_service.token_cache_key, 'expired_token')
+        mock_get.return_value = daraja_response({'access_token': 'fresh_token', 'expires_in': '3599'})
+        mock_post.side_effect = [
+            daraja_response(status_code=401),
+            daraja_response({'ResultCode': '0'}),
+        ]
+
+        result = self.mpesa_service.query_stk_status('checkout_123')
+
+        self.assertTrue(result['success'])
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(
+            mock_post.call_args.kwargs['headers']['Authorization'], 'Bearer fresh_token'
+        )
+
+    @patch('payments.services._push_session.post')
+    def test_stk_push_normalizes_phone_number(self, mock_post):
+        """Test STK push sends 254-prefixed numbers and rejects malformed ones"""
+        cache.set(self.mpesa_service.token_cache_key, 'test_token_123')
+        mock_post.return_value = daraja_response({'ResponseCode': '0'})
+
+        for phone in ('0712345678', '+254712345678', '254712345678', '712345678'):
+            result = self.mpesa_service.initiate_stk_push(phone, 100, 'ref', 'desc')
+            self.assertTrue(result['success'])
+            payload = orjson.loads(mock_post.call_args.kwargs['data'])
+            self.assertEqual(payload['PhoneNumber'], '254712345678')
+            self.assertEqual(payload['PartyA'], '254712345678')
+            self.assertEqual(mock_post.call_args.kwargs['timeout'], DARAJA_TIMEOUT)
+
+        mock_post.reset_mock()
+        result = self.mpesa_service.initiate_stk_push('07123', 100, 'ref', 'desc')
+        self.assertFalse(result['success'])
+        mock_post.assert_not_called()
+
+    def test_session_retries_transient_daraja_errors(self):
+        """Test the shared session retries throttled and 5xx responses"""
+        retry = _session.get_adapter(self.mpesa_service.base_url).max_retries
+
+        self.assertEqual(retry.total, 4)
+        self.assertTrue(retry.respect_retry_after_header)
+        self.assertIn('POST', retry.allowed_methods)
+        for status_code in (429, 500, 502, 503, 504):
+            self.assertTrue(retry.is_retry('POST', status_code))
+        self.assertFalse(retry.is_retry('POST', 400))
+
+    def test_stk_push_is_not_retried_after_server_errors(self):
+        """Test a 5xx push is not re-sent, since the PIN prompt may already be out"""
+        retry = _push_session.get_adapter(self.mpesa_service.base_url).max_retries
+
+        self.assertEqual(retry.read, 0)
+        self.assertTrue(retry.is_retry('POST', 429))
+        self.assertTrue(retry.is_retry('POST', 503, has_retry_after=True))
+        for status_code in (500, 502, 503, 504):
+            self.assertFalse(retry.is_retry('POST', status_code))
+
+        cache.set(self.mpesa_service.token_cache_key, 'test_token_123')
+        bad_gateway = HTTPResponse(
+            body=BytesIO(b'{"errorMessage": "Bad Gateway"}'), status=502,
+            headers={'Content-Type': 'application/json'}, preload_content=False
+        )
+        with patch(
+            'urllib3.connectionpool.HTTPConnectionPool._make_request', return_value=bad_gateway
+        ) as mock_request:
+            result = self.mpesa_service.initiate_stk_push('0712345678', 100, 'ref', 'desc')
+
+        self.assertFalse(result['success'])
+        self.assertEqual(result['error_message'], 'Bad Gateway')
+        mock_request.assert_called_once()
+
+    @patch('payments.services.time.sleep')
+    @patch('payments.services.time.time')
+    def test_daraja_requests_are_rate_limited(self, mock_time, mock_sleep):
+        """Test requests over the per-second quota wait for the next window"""
+        mock_time.return_value = 1000.25
+        mock_sleep.side_effect = lambda seconds: setattr(
+            mock_time, 'return_value', mock_time.return_value + seconds
+        )
+
+        _acquire_daraja_slot(2)
+        _acquire_daraja_slot(2)
+        mock_sleep.assert_not_called()
+
+        _acquire_daraja_slot(2)
+        mock_sleep.assert_called_once_with(0.75)
+
+    @patch('payments.services.cache.add', side_effect=ConnectionError('Redis down'))
+    def test_rate_limiter_fails_open_without_cache(self, mock_add):
+        """Test a cache outage lets Daraja requests through with a warning"""
+        with self.assertLogs('payments.services', 'WARNING'):
+            _acquire_daraja_slot(2)
+
+    @override_settings(MPESA_RATE_LIMIT=3)
+    @patch('payments.services._acquire_daraja_slot')
+    def test_retries_take_a_rate_limit_slot(self, mock_acquire):
+        """Test every urllib3 re-send draws from the Daraja quota"""
+        for retry in (DARAJA_RETRY, DARAJA_PUSH_RETRY):
+            retry.sleep()
+
+        self.assertEqual(mock_acquire.call_count, 2)
+        mock_acquire.assert_called_with(3)
+
+    def test_validate_callback_ip(self):
+        """Test callbacks are accepted only from Safaricom IPs outside sandbox"""
+        self.mpesa_service.environment = 'sandbox'
+        self.assertTrue(self.mpesa_service.validate_callback_ip('196.201.214.200'))
+        self.assertTrue(self.mpesa_service.validate_callback_ip('127.0.0.1'))
+        self.assertFalse(self.mpesa_service.validate_callback_ip('10.0.0.1'))
+
+        self.mpesa_service.environment = 'production'
+        self.assertTrue(self.mpesa_service.validate_callback_ip('196.201.214.200'))
+        self.assertFalse(self.mpesa_service.validate_callback_ip('127.0.0.1'))
+
+    @patch('payments.services._session.get')
     def test_get_access_token_failure(self, mock_get):
         """Test access token retrieval failure"""
         mock_get.side_effect = Exception('Network error')
@@ -163,6 +505,19 @@ class MpesaServiceTests(TestCase):
         token = self.mpesa_service.get_access_token()
         self.assertIsNone(token)
 
+        mock_get.side_effect = None
+        mock_get.return_value = daraja_response({'errorMessage': 'Invalid credentials'}, 400)
+        self.assertIsNone(self.mpesa_service.get_access_token())
+
+    def test_payment_status_for_result_code(self):
+        """Test STK result codes map to payment statuses"""
+        self.assertEqual(MpesaService.payment_status_for('0'), 'completed')
+        self.assertEqual(MpesaService.payment_status_for(0), 'completed')
+        self.assertEqual(MpesaService.payment_status_for('1032'), 'cancelled')
+        self.assertEqual(MpesaService.payment_status_for('1037'), 'cancelled')
+        self.assertEqual(MpesaService.payment_status_for('2001'), 'failed')
+        self.assertIsNone(MpesaService.payment_status_for(None))
+
     def test_generate_password(self):
         """Test password generation for STK push"""
         password, timestamp = self.mpesa_service.generate_password()
@@ -171,6 +526,15 @@ class MpesaServiceTests(TestCase):
         self.assertIsInstance(timestamp, str)
         self.assertEqual(len(timestamp), 14)  # Format: YYYYMMDDHHMMSS
 
+        # Daraja expects Nairobi time and base64(shortcode + passkey + timestamp)
+        stamped = datetime.strptime(timestamp, '%Y%m%d%H%M%S')
+        local_now = timezone.localtime().replace(tzinfo=None)
+        self.assertLess(abs((local_now - stamped).total_seconds()), 5)
+        self.assertEqual(
+            base64.b64decode(password).decode(),
+            f"{self.mpesa_service.shortcode}{self.mpesa_service.passkey}{timestamp}"
+        )
+
     def test_format_phone_number(self):
         """Test phone number formatting"""
         # Test various phone number formats
@@ -182,8 +546,8 @@ class MpesaServiceTests(TestCase):
         ]
 
         for input_phone, expected in test_cases:
-            formatted = format_mpesa_phone_number(input_phone)
-            self.assertEqual(formatted, expected)
+            with self.subTest(phone=input_phone):
+                self.assertEqual(format_mpesa_phone_number(input_phone), expected)
 
     def test_process_callback_success(self):
         """Test processing successful M-Pesa callback"""
@@ -214,6 +578,8 @@ class MpesaServiceTests(TestCase):
         self.assertEqual(processed['result_code'], '0')
         self.assertEqual(processed['metadata']['amount'], 618.0)
         self.assertEqual(processed['metadata']['mpesa_receipt_number'], 'ABC123')
+        self.assertEqual(processed['metadata']['phone_number'], 254712345678)
+        self.assertIn('transaction_date', processed['metadata'])
 
     def test_process_callback_failure(self):
         """Test processing failed M-Pesa callback"""
@@ -235,25 +601,229 @@ class MpesaServiceTests(TestCase):
         self.assertEqual(processed['result_desc'], 'Request cancelled by user')
 
 
-class PaymentUtilityTests(TestCase):
+class MpesaCallbackViewTests(APITestCase):
+    """Test the M-Pesa callback endpoint"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        self.order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('618.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        self.payment = Payment.objects.create(
+            order=self.order,
+            payer=self.buyer,
+            amount=Decimal('618.00'),
+            status='processing'
+        )
+        MpesaTransaction.objects.create(
+            payment=self.payment,
+            phone_number='254712345678',
+            checkout_request_id='checkout_123'
+        )
+        self.url = reverse('mpesa-callback')
+
+    def callback(self, result_code, items=()):
+        return {
+            'Body': {
+                'stkCallback': {
+                    'MerchantRequestID': 'merchant_123',
+                    'CheckoutRequestID': 'checkout_123',
+                    'ResultCode': result_code,
+                    'ResultDesc': 'Result',
+                    'CallbackMetadata': {'Item': list(items)}
+                }
+            }
+        }
+
+    def post_callback(self, data):
+        """Post ``data`` and run the task the view queues once it commits"""
+        with patch('payments.tasks.process_mpesa_callback.delay') as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    self.url, data, format='json', REMOTE_ADDR='196.201.214.200'
+                )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['ResultCode'], 0)
+        mock_delay.assert_called_once()
+        return process_mpesa_callback(*mock_delay.call_args.args)
+
+    def test_callback_is_acknowledged_before_processing(self):
+        """Test the view stores the webhook and leaves the payment to the task"""
+        with patch('payments.tasks.process_mpesa_callback.delay') as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    self.url, self.callback(0), format='json', REMOTE_ADDR='196.201.214.200'
+                )
+
+        webhook = PaymentWebhook.objects.get()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        mock_delay.assert_called_once_with(str(webhook.id))
+        self.assertFalse(webhook.processed)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'processing')
+
+    def test_successful_callback_marks_order_paid(self):
+        """Test a successful callback completes the payment and pays the order"""
+        result = self.post_callback(
+            self.callback(0, [{'Name': 'MpesaReceiptNumber', 'Value': 'ABC123'}])
+        )
+
+        self.assertTrue(result['processed'])
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.external_transaction_id, 'ABC123')
+        self.assertEqual(self.order.payment_status, 'paid')
+        self.assertEqual(self.payment.mpesa_transaction.mpesa_receipt_number, 'ABC123')
+        self.assertTrue(PaymentWebhook.objects.get(payment=self.payment).processed)
+
+    def test_callback_task_writes_without_reloading_rows(self):
+        """Test the task issues one UPDATE per row after its two lookups"""
+        with patch('payments.tasks.process_mpesa_callback.delay') as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    self.url, self.callback(0), format='json', REMOTE_ADDR='196.201.214.200'
+                )
+
+        # SAVEPOINT, webhook and transaction SELECTs, four UPDATEs, RELEASE
+        with self.assertNumQueries(8):
+            process_mpesa_callback(*mock_delay.call_args.args)
+
+        self.assertEqual(PaymentWebhook.objects.get().payment, self.payment)
+
+    def test_failed_callback_marks_payment_failed(self):
+        """Test a failed callback records the failure and leaves the order unpaid"""
+        self.post_callback(self.callback(2001))
+
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.status, 'failed')
+        self.assertEqual(self.payment.failure_reason, 'Result')
+        self.assertNotEqual(self.order.payment_status, 'paid')
+
+    def test_callback_before_transaction_commit_is_retried(self):
+        """Test an unknown checkout request raises so the task retries"""
+        MpesaTransaction.objects.all().delete()
+
+        with self.assertRaises(MpesaTransaction.DoesNotExist):
+            self.post_callback(self.callback(0))
+
+        self.assertFalse(PaymentWebhook.objects.get().processed)
+
+
+class PaymentListViewTests(APITestCase):
+    """Test the payment list endpoint"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        self.client.force_authenticate(self.buyer)
+        self.url = reverse('payment-list-create')
+
+    def create_payment(self):
+        order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('618.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        return Payment.objects.create(order=order, payer=self.buyer, amount=Decimal('618.00'))
+
+    def test_list_query_count_is_independent_of_page_size(self):
+        """Test each payment's order summary is joined, not fetched per row"""
+        self.create_payment()
+        with CaptureQueriesContext(connection) as single:
+            self.client.get(self.url)
+
+        self.create_payment()
+        self.create_payment()
+        with self.assertNumQueries(len(single)):
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['results'][0]['order_details']['total_amount'], '618.00')
+
+    @patch('payments.views.payment_service.initiate_payment')
+    def test_create_payment_holds_escrow_for_farmer(self, mock_initiate):
+        """Test a successful payment opens escrow for the order's farmer"""
+        mock_initiate.return_value = {'success': True, 'message': 'Payment initiated'}
+        farmer = User.objects.create_user(
+            email='farmer@example.com',
+            username='farmer',
+            password='testpass123',
+            role='farmer'
+        )
+        product = Product.objects.create(
+            farmer=farmer,
+            category=ProductCategory.objects.create(name='Vegetables'),
+            name='Tomatoes',
+            description='Fresh tomatoes',
+            price_per_unit=Decimal('50.00'),
+            unit='kg',
+            quantity_available=Decimal('100.00'),
+            county='Kisii'
+        )
+        order = self.create_payment().order
+        OrderItem.objects.create(
+            order=order, product=product, quantity=10, unit_price=Decimal('50.00')
+        )
+
+        response = self.client.post(self.url, {
+            'order': str(order.id),
+            'amount': '618.00',
+            'payment_method': 'cash'
+        }, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        escrow = EscrowAccount.objects.get(payment__payment_id=response.data['payment_id'])
+        self.assertEqual(escrow.seller, farmer)
+
+
+class PaymentUtilityTests(SimpleTestCase):
     """Test payment utility functions"""
 
-    def test_validate_payment_amount_valid(self):
-        """Test valid payment amount validation"""
-        result = validate_payment_amount(100.0, 100.0)
-        self.assertTrue(result['valid'])
+    def test_generate_ulid_sorts_by_time(self):
+        """Test payment IDs are time-ordered ULIDs"""
+        with patch('core.utils.time.time', return_value=1700000000.0):
+            earlier = generate_ulid()
+        with patch('core.utils.time.time', return_value=1700000000.001):
+            later = generate_ulid()
+
+        self.assertEqual(len(earlier), 26)
+        self.assertTrue(set(earlier) <= set(ULID_ALPHABET))
+        self.assertLess(earlier, later)
 
-    def test_validate_payment_amount_invalid_zero(self):
-        """Test invalid zero payment amount"""
-        result = validate_payment_amount(0.0, 100.0)
-        self.assertFalse(result['valid'])
-        self.assertIn('greater than zero', result['message'])
+    def test_validate_payment_amount(self):
+        """Test payment amount validation"""
+        test_cases = [
+            (Decimal('100.00'), Decimal('100.00'), True, None),
+            (Decimal('0.00'), Decimal('100.00'), False, 'greater than zero'),
+            (Decimal('90.00'), Decimal('100.00'), False, 'does not match'),
+            (0.1 + 0.2, Decimal('0.30'), True, None),
+        ]
 
-    def test_validate_payment_amount_mismatch(self):
-        """Test payment amount mismatch"""
-        result = validate_payment_amount(90.0, 100.0)
-        self.assertFalse(result['valid'])
-        self.assertIn('does not match', result['message'])
+        for amount, expected_amount, valid, message in test_cases:
+            with self.subTest(amount=amount, expected_amount=expected_amount):
+                result = validate_payment_amount(amount, expected_amount)
+                self.assertEqual(result['valid'], valid)
+                if message:
+                    self.assertIn(message, result['message'])
 
     def test_format_mpesa_phone_number(self):
         """Test M-Pesa phone number formatting"""
@@ -261,8 +831,581 @@ class PaymentUtilityTests(TestCase):
             ('0712345678', '254712345678'),
             ('+254712345678', '254712345678'),
             ('254712345678', '254712345678'),
+            ('+254 712-345 678', '254712345678'),
+            ('(0712) 345 678', '254712345678'),
         ]
 
         for input_phone, expected in test_cases:
-            result = format_mpesa_phone_number(input_phone)
-            self.assertEqual(result, expected)
+            with self.subTest(phone=input_phone):
+                self.assertEqual(format_mpesa_phone_number(input_phone), expected)
+
+
+class PaymentWebhookTests(TestCase):
+    """Test webhook storage"""
+
+    def callback(self, checkout_request_id):
+        return {
+            'Body': {
+                'stkCallback': {
+                    'MerchantRequestID': 'merchant_123',
+                    'CheckoutRequestID': checkout_request_id,
+                    'ResultCode': 0
+                }
+            }
+        }
+
+    def test_save_sets_dedup_key(self):
+        """Test the checkout request id becomes the dedup key"""
+        webhook = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback', raw_data=self.callback('checkout_1')
+        )
+        self.assertEqual(webhook.dedup_key, 'checkout_1')
+
+    def test_dedup_key_ignores_malformed_callbacks(self):
+        """Test payloads without a well-formed stkCallback have no dedup key"""
+        for raw_data in (
+            None,
+            [],
+            {'Body': 'not a dict'},
+            {'Body': {'stkCallback': ['not', 'a', 'dict']}},
+            {'Body': {'stkCallback': {'CheckoutRequestID': {'nested': True}}}},
+        ):
+            with self.subTest(raw_data=raw_data):
+                self.assertIsNone(PaymentWebhook.dedup_key_for(raw_data))
+
+        webhook = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback', raw_data={'Body': 'not a dict'}
+        )
+        self.assertIsNone(webhook.dedup_key)
+
+    def test_cleanup_old_webhooks(self):
+        """Test webhooks past retention are purged and counted"""
+        old = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback', raw_data=self.callback('checkout_1')
+        )
+        recent = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback', raw_data=self.callback('checkout_2')
+        )
+        PaymentWebhook.objects.filter(pk=old.pk).update(
+            created_at=timezone.now() - timedelta(days=31)
+        )
+
+        result = cleanup_old_webhooks()
+
+        self.assertEqual(result['deleted_count'], 1)
+        self.assertEqual(list(PaymentWebhook.objects.values_list('pk', flat=True)), [recent.pk])
+
+    def test_archive_processed_webhooks(self):
+        """Test old processed payloads are compressed and still readable"""
+        old = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback',
+            raw_data=self.callback('checkout_1'),
+            processed=True
+        )
+        recent = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback',
+            raw_data=self.callback('checkout_2'),
+            processed=True
+        )
+        PaymentWebhook.objects.filter(pk=old.pk).update(
+            created_at=timezone.now() - timedelta(days=WEBHOOK_ARCHIVE_DAYS + 1)
+        )
+
+        result = archive_processed_webhooks()
+
+        self.assertEqual(result['archived_count'], 1)
+        old.refresh_from_db()
+        recent.refresh_from_db()
+        self.assertIsNone(old.raw_data)
+        self.assertEqual(old.payload, self.callback('checkout_1'))
+        self.assertEqual(recent.payload, self.callback('checkout_2'))
+
+
+class PaymentTaskTests(TestCase):
+    """Test payment Celery tasks"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        self.order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('618.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        self.payment = Payment.objects.create(
+            order=self.order,
+            payer=self.buyer,
+            amount=Decimal('618.00'),
+            status='processing'
+        )
+        self.mpesa_transaction = MpesaTransaction.objects.create(
+            payment=self.payment,
+            phone_number='254712345678',
+            checkout_request_id='checkout_123'
+        )
+
+    def test_auto_release_escrow_funds(self):
+        """Test escrows release once held for their own window with a completed payment"""
+        seller = User.objects.create_user(
+            email='seller@example.com',
+            username='seller',
+            password='testpass123',
+            role='farmer'
+        )
+        escrows = {}
+        for name, days, payment_status, auto_release_days in [
+            ('due', 8, 'completed', 7),
+            ('short_window', 4, 'completed', 3),
+            ('not_yet_due', 5, 'completed', 7),
+            ('unpaid', 10, 'processing', 7),
+        ]:
+            order = Order.objects.create(
+                buyer=self.buyer,
+                total_amount=Decimal('100.00'),
+                delivery_address='Test Address',
+                delivery_county='Kisii',
+                delivery_phone='+254712345678'
+            )
+            payment = Payment.objects.create(
+                order=order, payer=self.buyer, amount=Decimal('100.00'), status=payment_status
+            )
+            escrow = EscrowAccount.objects.create(
+                payment=payment, seller=seller, amount=Decimal('100.00'),
+                auto_release_days=auto_release_days
+            )
+            EscrowAccount.objects.filter(pk=escrow.pk).update(
+                created_at=timezone.now() - timedelta(days=days)
+            )
+            escrows[name] = escrow
+
+        result = auto_release_escrow_funds()
+
+        self.assertEqual(result['released_count'], 2)
+        released = set(
+            EscrowAccount.objects.filter(status='released').values_list('pk', flat=True)
+        )
+        self.assertEqual(released, {escrows['due'].pk, escrows['short_window'].pk})
+
+    def test_send_payment_notifications(self):
+        """Test notifications resolve the payment reference with one query"""
+        with self.assertNumQueries(1):
+            result = send_payment_notifications(self.payment.id, 'payment_completed')
+
+        self.assertEqual(result['payment_id'], self.payment.payment_id)
+        self.assertEqual(result['notifications_sent'], 2)
+        self.assertEqual(
+            send_payment_notifications(uuid.uuid4(), 'payment_failed'),
+            {'error': 'Payment not found'}
+        )
+
+    def test_process_pending_webhooks(self):
+        """Test stored callbacks are applied in bulk"""
+        webhook = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback',
+            raw_data={
+                'Body': {
+                    'stkCallback': {
+                        'MerchantRequestID': 'merchant_123',
+                        'CheckoutRequestID': 'checkout_123',
+                        'ResultCode': 0,
+                        'ResultDesc': 'Success',
+                        'CallbackMetadata': {
+                            'Item': [{'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'}]
+                        }
+                    }
+                }
+            }
+        )
+        orphan = PaymentWebhook.objects.create(
+            webhook_type='mpesa_callback',
+            raw_data={'Body': {'stkCallback': {'CheckoutRequestID': 'unknown', 'ResultCode': 0}}}
+        )
+
+        # Fresh callbacks still belong to their own task's retries
+        self.assertEqual(process_pending_webhooks()['processed_count'], 0)
+
+        PaymentWebhook.objects.update(
+            created_at=timezone.now() - WEBHOOK_SWEEP_GRACE - timedelta(seconds=1)
+        )
+        with self.assertNumQueries(8):
+            result = process_pending_webhooks()
+
+        self.assertEqual(result['processed_count'], 1)
+        webhook.refresh_from_db()
+        orphan.refresh_from_db()
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertTrue(webhook.processed)
+        self.assertEqual(webhook.payment, self.payment)
+        self.assertEqual(orphan.processing_error, 'M-Pesa transaction not found')
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.external_transaction_id, 'NLJ7RT61SV')
+        self.assertEqual(self.order.payment_status, 'paid')
+
+    @patch('payments.services.MpesaService.query_stk_status')
+    def test_sync_mpesa_transaction_status(self, mock_query):
+        """Test queried statuses are written back in bulk"""
+        mock_query.return_value = {
+            'success': True,
+            'data': {'ResultCode': '1032', 'ResultDesc': 'Cancelled by user'}
+        }
+
+        result = sync_mpesa_transaction_status()
+
+        self.assertEqual(result['updated_count'], 1)
+        self.payment.refresh_from_db()
+        self.mpesa_transaction.refresh_from_db()
+        self.assertEqual(self.payment.status, 'cancelled')
+        self.assertEqual(self.mpesa_transaction.result_code, '1032')
+
+
+class PaymentAnalyticsTests(TestCase):
+    """Test payment analytics counters"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        cls.order = Order.objects.create(
+            buyer=cls.buyer,
+            total_amount=Decimal('600.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+
+    def create_payment(self, amount, payment_status, method):
+        return Payment.objects.create(
+            order=self.order, payer=self.buyer, amount=Decimal(amount),
+            status=payment_status, payment_method=method
+        )
+
+    def test_increment_creates_and_accumulates(self):
+        """Test increments create the day's row and add in SQL"""
+        day = date(2026, 10, 16)
+
+        PaymentAnalytics.increment(day, total_transactions=1, total_amount=Decimal('150.00'))
+        PaymentAnalytics.increment(day, total_transactions=1, total_amount=Decimal('50.00'))
+
+        analytics = PaymentAnalytics.objects.get(date=day)
+        self.assertEqual(analytics.total_transactions, 2)
+        self.assertEqual(analytics.total_amount, Decimal('200.00'))
+        self.assertEqual(analytics.failed_transactions, 0)
+
+    def test_generate_daily_payment_analytics(self):
+        """Test yesterday's metrics are aggregated and written in one pass"""
+        for amount, payment_status, method in [
+            ('100.00', 'completed', 'mpesa'),
+            ('200.00', 'paid', 'cash'),
+            ('300.00', 'failed', 'mpesa'),
+        ]:
+            self.create_payment(amount, payment_status, method)
+        yesterday = timezone.now() - timedelta(days=1)
+        Payment.objects.update(created_at=yesterday)
+        PaymentAnalytics.increment(yesterday.date(), total_transactions=99)
+
+        with self.assertNumQueries(4):
+            PaymentAnalyticsCalculator.rollup_day(yesterday.date())
+        result = generate_daily_payment_analytics()
+
+        analytics = PaymentAnalytics.objects.get(date=yesterday.date())
+        self.assertEqual(result['total_transactions'], 3)
+        self.assertEqual(analytics.total_transactions, 3)
+        self.assertEqual(analytics.successful_transactions, 2)
+        self.assertEqual(analytics.failed_transactions, 1)
+        self.assertEqual(analytics.total_amount, Decimal('300.00'))
+        self.assertEqual(analytics.total_fees_collected, Decimal('9.00'))
+        self.assertEqual(analytics.mpesa_transactions, 1)
+        self.assertEqual(analytics.mpesa_amount, Decimal('100.00'))
+
+    def test_generate_daily_payment_analytics_refreshes_recent_days(self):
+        """Test payments completed after their first rollup reach the analytics"""
+        payment = self.create_payment('250.00', 'pending', 'cash')
+        created = timezone.localdate() - timedelta(days=ANALYTICS_RECOMPUTE_DAYS)
+        Payment.objects.filter(pk=payment.pk).update(
+            created_at=timezone.now() - timedelta(days=ANALYTICS_RECOMPUTE_DAYS)
+        )
+
+        generate_daily_payment_analytics()
+        self.assertEqual(PaymentAnalytics.objects.get(date=created).total_amount, Decimal('0'))
+
+        Payment.objects.filter(pk=payment.pk).update(status='completed')
+        generate_daily_payment_analytics()
+        self.assertEqual(PaymentAnalytics.objects.get(date=created).total_amount, Decimal('250.00'))
+
+    def test_backfill_payment_analytics(self):
+        """Test the backfill command rolls up every day from the first payment"""
+        self.create_payment('100.00', 'completed', 'mpesa')
+        first_day = timezone.localdate() - timedelta(days=40)
+        Payment.objects.update(created_at=timezone.now() - timedelta(days=40))
+
+        call_command('backfill_payment_analytics', stdout=StringIO())
+
+        self.assertEqual(PaymentAnalytics.objects.count(), 40)
+        self.assertEqual(PaymentAnalytics.objects.get(date=first_day).total_amount, Decimal('100.00'))
+
+    def test_get_payment_summary(self):
+        """Test the payment summary is computed in a single query"""
+        for amount, payment_status, method in [
+            ('100.00', 'completed', 'mpesa'),
+            ('200.00', 'paid', 'cash'),
+            ('300.00', 'failed', 'mpesa'),
+            ('400.00', 'pending', 'bank'),
+        ]:
+            self.create_payment(amount, payment_status, method)
+
+        with self.assertNumQueries(1):
+            summary = PaymentAnalyticsCalculator.get_payment_summary()
+
+        self.assertEqual(summary['total_payments'], 4)
+        self.assertEqual(summary['completed_payments'], 2)
+        self.assertEqual(summary['failed_payments'], 1)
+        self.assertEqual(summary['pending_payments'], 1)
+        self.assertEqual(summary['total_amount'], Decimal('300.00'))
+        self.assertEqual(summary['payment_methods'], {'mpesa': 2, 'bank': 1, 'cash': 1})
+        self.assertEqual(summary['success_rate'], 50.0)
+
+    def test_get_revenue_analytics(self):
+        """Test past days come from the rollup and today is summed live"""
+        self.create_payment('100.10', 'completed', 'mpesa')
+        self.create_payment('200.20', 'paid', 'cash')
+        yesterday = timezone.localdate() - timedelta(days=1)
+        PaymentAnalytics.increment(
+            yesterday, total_transactions=4, total_amount=Decimal('50.00'),
+            total_fees_collected=Decimal('1.50')
+        )
+
+        with self.assertNumQueries(2):
+            revenue = PaymentAnalyticsCalculator.get_revenue_analytics()
+
+        self.assertEqual(revenue['total_revenue'], Decimal('350.30'))
+        self.assertEqual(revenue['platform_fees'], Decimal('10.5090'))
+        self.assertEqual(revenue['net_revenue'], Decimal('339.7910'))
+        self.assertEqual(revenue['daily_breakdown'], [{
+            'date': yesterday.isoformat(),
+            'transactions': 4,
+            'revenue': Decimal('50.00'),
+            'fees_collected': Decimal('1.50'),
+        }])
+
+    def test_escrow_releases_roll_up_on_the_local_day(self):
+        """Test a late-evening UTC release counts on the Nairobi day it happened"""
+        escrow = EscrowAccount.objects.create(
+            payment=self.create_payment('100.00', 'completed', 'mpesa'),
+            seller=self.buyer,
+            amount=Decimal('100.00')
+        )
+        PaymentProcessingService(MpesaService()).release_escrow_funds(str(escrow.id))
+        self.assertFalse(PaymentAnalytics.objects.exists())
+
+        # 01:00 in Nairobi is still 22:00 the previous day in UTC
+        EscrowAccount.objects.filter(pk=escrow.pk).update(
+            release_date=timezone.make_aware(datetime(2026, 10, 16, 1, 0))
+        )
+        self.assertEqual(
+            PaymentAnalyticsCalculator.rollup_day(date(2026, 10, 15))['escrow_releases'], 0
+        )
+        self.assertEqual(
+            PaymentAnalyticsCalculator.rollup_day(date(2026, 10, 16))['escrow_releases'], 1
+        )
+
+    def test_get_escrow_summary(self):
+        """Test the escrow summary, holding time included, is one query"""
+        now = timezone.now()
+        for days_held, escrow_status in [(2, 'released'), (4, 'released'), (1, 'active')]:
+            escrow = EscrowAccount.objects.create(
+                payment=self.create_payment('100.00', 'completed', 'mpesa'),
+                seller=self.buyer,
+                amount=Decimal('100.00'),
+                status=escrow_status,
+                release_date=now if escrow_status == 'released' else None
+            )
+            EscrowAccount.objects.filter(pk=escrow.pk).update(
+                created_at=now - timedelta(days=days_held)
+            )
+
+        with self.assertNumQueries(1):
+            summary = PaymentAnalyticsCalculator.get_escrow_summary()
+
+        self.assertEqual(summary['total_escrow_accounts'], 3)
+        self.assertEqual(summary['released_escrow'], 2)
+        self.assertEqual(summary['total_amount_in_escrow'], Decimal('100.00'))
+        self.assertEqual(summary['total_amount_released'], Decimal('200.00'))
+        self.assertAlmostEqual(summary['average_holding_days'], 3.0)
+
+
+class PaymentRefundCreateSerializerTests(TestCase):
+    """Test refund request validation"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('500.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        self.payment = Payment.objects.create(
+            order=order,
+            payer=self.buyer,
+            amount=Decimal('500.00'),
+            status='completed'
+        )
+
+    def get_serializer(self, amount):
+        return PaymentRefundCreateSerializer(data={
+            'payment': self.payment.pk,
+            'amount': amount,
+            'reason': 'Damaged produce'
+        })
+
+    def test_refund_within_remaining_amount(self):
+        """Test refund fits alongside active refunds"""
+        PaymentRefund.objects.create(
+            payment=self.payment, amount=Decimal('300.00'), reason='Partial'
+        )
+        PaymentRefund.objects.create(
+            payment=self.payment, amount=Decimal('400.00'), reason='Failed', status='failed'
+        )
+
+        self.assertTrue(self.get_serializer('200.00').is_valid())
+
+    def test_refund_exceeding_remaining_amount(self):
+        """Test total active refunds cannot exceed the payment"""
+        PaymentRefund.objects.create(
+            payment=self.payment, amount=Decimal('300.00'), reason='Partial'
+        )
+
+        serializer = self.get_serializer('250.00')
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('amount', serializer.errors)
+
+
+class SyncPaymentStatusCommandTests(TestCase):
+    """Test the sync_payment_status management command"""
+
+    def setUp(self):
+        self.buyer = User.objects.create_user(
+            email='buyer@example.com',
+            username='buyer',
+            password='testpass123',
+            role='buyer'
+        )
+        self.order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('618.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+
+    def create_mpesa_payment(self, checkout_request_id):
+        payment = Payment.objects.create(
+            order=self.order,
+            payer=self.buyer,
+            amount=Decimal('618.00'),
+            payment_method='mpesa'
+        )
+        MpesaTransaction.objects.create(
+            payment=payment,
+            phone_number='254712345678',
+            checkout_request_id=checkout_request_id
+        )
+        return payment
+
+    @patch('payments.services.MpesaService.query_stk_status')
+    def test_sync_mpesa_payments(self, mock_query):
+        """Test STK query results are written back to payments"""
+        completed = self.create_mpesa_payment('checkout_ok')
+        cancelled = self.create_mpesa_payment('checkout_cancelled')
+        results = {
+            'checkout_ok': {'ResultCode': '0', 'ResultDesc': 'Success'},
+            'checkout_cancelled': {'ResultCode': '1032', 'ResultDesc': 'Cancelled by user'},
+        }
+        mock_query.side_effect = lambda checkout_id: {
+            'success': True, 'data': results[checkout_id]
+        }
+
+        call_command('sync_payment_status', stdout=StringIO())
+
+        completed.refresh_from_db()
+        cancelled.refresh_from_db()
+        self.assertEqual(completed.status, 'completed')
+        self.assertIsNotNone(completed.payment_date)
+        self.assertEqual(cancelled.status, 'cancelled')
+        self.assertEqual(cancelled.mpesa_transaction.result_code, '1032')
+
+    @patch('payments.management.commands.sync_payment_status.SYNC_CHUNK_SIZE', 1)
+    @patch('payments.services.MpesaService.query_stk_status')
+    def test_sync_in_chunks(self, mock_query):
+        """Test every chunk of a streamed backlog is written back"""
+        payments = [self.create_mpesa_payment(f'checkout_{i}') for i in range(3)]
+        mock_query.return_value = {'success': True, 'data': {'ResultCode': '0'}}
+
+        call_command('sync_payment_status', stdout=StringIO())
+
+        self.assertEqual(mock_query.call_count, 3)
+        self.assertEqual(
+            Payment.objects.filter(
+                pk__in=[payment.pk for payment in payments], status='completed'
+            ).count(),
+            3
+        )
+
+    def test_sync_delivered_cash_payments(self):
+        """Test cash payments complete once their order is delivered"""
+        delivered = Payment.objects.create(
+            order=self.order,
+            payer=self.buyer,
+            amount=Decimal('618.00'),
+            payment_method='cash'
+        )
+        Order.objects.filter(pk=self.order.pk).update(status='delivered')
+        undelivered_order = Order.objects.create(
+            buyer=self.buyer,
+            total_amount=Decimal('100.00'),
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345678'
+        )
+        undelivered = Payment.objects.create(
+            order=undelivered_order,
+            payer=self.buyer,
+            amount=Decimal('100.00'),
+            payment_method='cash'
+        )
+
+        call_command('sync_payment_status', '--payment-method', 'cash', stdout=StringIO())
+
+        delivered.refresh_from_db()
+        undelivered.refresh_from_db()
+        self.assertEqual(delivered.status, 'completed')
+        self.assertIsNotNone(delivered.payment_date)
+        self.assertEqual(undelivered.status, 'pending')
+
+    @patch('payments.services.MpesaService.query_stk_status')
+    def test_sync_dry_run(self, mock_query):
+        """Test dry run leaves payments untouched"""
+        payment = self.create_mpesa_payment('checkout_ok')
+        mock_query.return_value = {'success': True, 'data': {'ResultCode': '0'}}
+
+        call_command('sync_payment_status', '--dry-run', stdout=StringIO())
+
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, 'pending')
@@ -1,12 +1,32 @@
+from django.db import transaction
 from django.utils import timezone
-from django.db.models import Sum, Count, Q
-from datetime import timedelta
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Q, Sum
+from datetime import datetime, time, timedelta
+from decimal import Decimal
 from typing import Dict, List, Optional
 from .models import Payment, EscrowAccount, PaymentAnalytics
 import logging
 
 logger = logging.getLogger(__name__)
 
+def local_day_bounds(start_date, end_date=None):
+    """
+    Return aware datetimes [start, end) covering ``start_date`` through
+    ``end_date`` in the current time zone. Filtering on these keeps the
+    created_at indexes usable where a ``__date`` lookup casts every row
+    """
+    end_date = end_date or start_date
+    return (
+        timezone.make_aware(datetime.combine(start_date, time.min)),
+        timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min)),
+    )
+
+
+# Translation table deleting every ASCII character that is not a digit
+_NON_DIGITS = str.maketrans('', '', ''.join(c for c in map(chr, range(128)) if not c.isdigit()))
+
+_CENT = Decimal('0.01')
+
 
 class EscrowManager:
     """Utility class for managing escrow operations"""
@@ -15,38 +35,44 @@ class EscrowManager:
     def create_escrow_for_order(order, payment) -> Optional[EscrowAccount]:
         """Create escrow accounts for all sellers in an order"""
         try:
-            escrow_accounts = []
-
-            # Get unique sellers from order items
-            sellers = set()
-            for item in order.items.select_related('product__farmer'):
-                sellers.add(item.product.farmer)
-
-            # For multi-vendor orders, split payment proportionally
-            total_order_amount = order.total_amount
+            with transaction.atomic():
+                # Lock the payment so concurrent callbacks create its escrow once
+                payment = Payment.objects.select_for_update().only('id', 'amount').get(pk=payment.pk)
+                existing = EscrowAccount.objects.filter(payment=payment).first()
+                if existing:
+                    return existing
+
+                # Each seller's share of the order, summed in one grouped query
+                seller_totals = order.items.values('product__farmer').annotate(
+                    seller_amount=Sum(F('quantity') * F('unit_price'))
+                ).order_by()
+
+                # For multi-vendor orders, split payment proportionally
+                total_order_amount = order.total_amount
+                if not total_order_amount:
+                    logger.warning("Order %s has no total to split into escrow", order.id)
+                    return None
+
+                escrow_accounts = EscrowAccount.objects.bulk_create([
+                    EscrowAccount(
+                        payment=payment,
+                        seller_id=row['product__farmer'],
+                        amount=(row['seller_amount'] / total_order_amount * payment.amount).quantize(_CENT),
+                        status='active'
+                    )
+                    for row in seller_totals
+                ], batch_size=500)
 
-            for seller in sellers:
-                # Calculate seller's portion of the order
-                seller_items = order.items.filter(product__farmer=seller)
-                seller_amount = sum(item.quantity * item.price_per_unit for item in seller_items)
-
-                # Calculate proportional payment amount
-                escrow_amount = (seller_amount / total_order_amount) * payment.amount
-
-                escrow = EscrowAccount.objects.create(
-                    payment=payment,
-                    seller=seller,
-                    amount=escrow_amount,
-                    status='active'
+            for escrow in escrow_accounts:
+                logger.info(
+                    "Created escrow account %s for seller %s - Amount: %s",
+                    escrow.id, escrow.seller_id, escrow.amount
                 )
-                escrow_accounts.append(escrow)
-
-                logger.info(f"Created escrow account {escrow.id} for seller {seller.id} - Amount: {escrow_amount}")
 
             return escrow_accounts[0] if escrow_accounts else None
 
         except Exception as e:
-            logger.error(f"Error creating escrow for order {order.id}: {e}")
+            logger.error("Error creating escrow for order %s: %s", order.id, e)
             return None
 
     @staticmethod
@@ -54,9 +80,11 @@ class EscrowManager:
         """Get escrow status for a payment"""
         try:
             payment = Payment.objects.get(payment_id=payment_id)
-            escrow_accounts = EscrowAccount.objects.filter(payment=payment)
+            escrow_accounts = list(
+                EscrowAccount.objects.filter(payment=payment).select_related('seller')
+            )
 
-            if not escrow_accounts.exists():
+            if not escrow_accounts:
                 return {
                     'has_escrow': False,
                     'message': 'No escrow accounts found for this payment'
@@ -90,7 +118,7 @@ class EscrowManager:
                 'error': 'Payment not found'
             }
         except Exception as e:
-            logger.error(f"Error getting escrow status: {e}")
+            logger.error("Error getting escrow status: %s", e)
             return {
                 'has_escrow': False,
                 'error': str(e)
@@ -100,33 +128,34 @@ class EscrowManager:
     def release_all_escrow_for_payment(payment_id: str, release_reason: str = '') -> Dict:
         """Release all escrow accounts for a payment"""
         try:
-            payment = Payment.objects.get(payment_id=payment_id)
+            payment = Payment.objects.only('id').get(payment_id=payment_id)
             escrow_accounts = EscrowAccount.objects.filter(
                 payment=payment,
                 status='active'
             )
+            now = timezone.now()
 
-            if not escrow_accounts.exists():
-                return {
-                    'success': False,
-                    'message': 'No active escrow accounts found'
-                }
-
-            released_count = 0
-            total_released = 0
-
-            for escrow in escrow_accounts:
-                escrow.status = 'released'
-                escrow.release_date = timezone.now()
-                escrow.resolution_notes = release_reason
-                escrow.save()
-
-                released_count += 1
-                total_released += escrow.amount
+            with transaction.atomic():
+                # Lock the rows so the reported total matches what is released
+                amounts = list(
+                    escrow_accounts.select_for_update().values_list('amount', flat=True)
+                )
+                if not amounts:
+                    return {
+                        'success': False,
+                        'message': 'No active escrow accounts found'
+                    }
+
+                released_count = escrow_accounts.update(
+                    status='released',
+                    release_date=now,
+                    resolution_notes=release_reason,
+                    updated_at=now
+                )
+                total_released = sum(amounts)
 
-            # Update payment status
-            payment.status = 'completed'
-            payment.save()
+                # Update payment status
+                Payment.objects.filter(pk=payment.pk).update(status='completed', updated_at=now)
 
             return {
                 'success': True,
@@ -141,7 +170,7 @@ class EscrowManager:
                 'message': 'Payment not found'
             }
         except Exception as e:
-            logger.error(f"Error releasing escrow for payment {payment_id}: {e}")
+            logger.error("Error releasing escrow for payment %s: %s", payment_id, e)
             return {
                 'success': False,
                 'message': str(e)
@@ -164,7 +193,7 @@ class EscrowManager:
             escrow.dispute_date = timezone.now()
             escrow.save()
 
-            logger.info(f"Escrow {escrow_id} disputed by user {disputer_id}: {dispute_reason}")
+            logger.info("Escrow %s disputed by user %s: %s", escrow_id, disputer_id, dispute_reason)
 
             return {
                 'success': True,
@@ -177,7 +206,7 @@ class EscrowManager:
                 'message': 'Escrow account not found'
             }
         except Exception as e:
-            logger.error(f"Error disputing escrow {escrow_id}: {e}")
+            logger.error("Error disputing escrow %s: %s", escrow_id, e)
             return {
                 'success': False,
                 'message': str(e)
@@ -187,6 +216,48 @@ class EscrowManager:
 class PaymentAnalyticsCalculator:
     """Utility class for calculating payment analytics"""
 
+    @staticmethod
+    def rollup_day(day) -> Dict:
+        """
+        Aggregate ``day``'s payments and escrows into its PaymentAnalytics row,
+        replacing whatever the row held before
+        """
+        successful = Q(status__in=['completed', 'paid'])
+
+        # Payment metrics for the day in a single pass over the table
+        day_start, day_end = local_day_bounds(day)
+        payment_totals = Payment.objects.filter(
+            created_at__gte=day_start, created_at__lt=day_end
+        ).aggregate(
+            total_transactions=Count('id'),
+            successful_transactions=Count('id', filter=successful),
+            failed_transactions=Count('id', filter=Q(status='failed')),
+            total_amount=Sum('amount', filter=successful),
+            mpesa_transactions=Count('id', filter=successful & Q(payment_method='mpesa')),
+            mpesa_amount=Sum('amount', filter=successful & Q(payment_method='mpesa')),
+        )
+
+        # Escrow metrics
+        escrow_totals = EscrowAccount.objects.filter(
+            Q(status='active', created_at__gte=day_start, created_at__lt=day_end)
+            | Q(status='released', release_date__gte=day_start, release_date__lt=day_end)
+        ).aggregate(
+            amount_in_escrow=Sum('amount', filter=Q(status='active')),
+            escrow_releases=Count('id', filter=Q(status='released')),
+        )
+
+        metrics = {
+            field: value or 0
+            for field, value in {**payment_totals, **escrow_totals}.items()
+        }
+        # Calculate platform fees (3% default)
+        metrics['total_fees_collected'] = metrics['total_amount'] * Decimal('0.03')
+
+        # Create the day's row if needed, then write every metric in one UPDATE
+        PaymentAnalytics.objects.bulk_create([PaymentAnalytics(date=day)], ignore_conflicts=True)
+        PaymentAnalytics.objects.filter(date=day).update(updated_at=timezone.now(), **metrics)
+        return metrics
+
     @staticmethod
     def get_payment_summary(start_date=None, end_date=None) -> Dict:
         """Get payment summary for a date range"""
@@ -196,28 +267,34 @@ class PaymentAnalyticsCalculator:
             if not end_date:
                 end_date = timezone.now().date()
 
-            payments = Payment.objects.filter(
-                created_at__date__range=[start_date, end_date]
+            start, end = local_day_bounds(start_date, end_date)
+            payments = Payment.objects.filter(created_at__gte=start, created_at__lt=end)
+
+            # Counts, completed amount and method breakdown in one pass
+            completed = Q(status__in=['completed', 'paid'])
+            totals = payments.aggregate(
+                total_payments=Count('id'),
+                completed_payments=Count('id', filter=completed),
+                failed_payments=Count('id', filter=Q(status='failed')),
+                pending_payments=Count('id', filter=Q(status__in=['pending', 'processing'])),
+                total_amount=Sum('amount', filter=completed),
+                mpesa=Count('id', filter=Q(payment_method='mpesa')),
+                bank=Count('id', filter=Q(payment_method='bank')),
+                cash=Count('id', filter=Q(payment_method='cash')),
             )
 
             summary = {
-                'total_payments': payments.count(),
-                'completed_payments': payments.filter(status__in=['completed', 'paid']).count(),
-                'failed_payments': payments.filter(status='failed').count(),
-                'pending_payments': payments.filter(status__in=['pending', 'processing']).count(),
-            }
-
-            # Amount calculations
-            completed_payments = payments.filter(status__in=['completed', 'paid'])
-            summary['total_amount'] = float(completed_payments.aggregate(
-                total=Sum('amount')
-            )['total'] or 0)
-
-            # Payment method breakdown
-            summary['payment_methods'] = {
-                'mpesa': payments.filter(payment_method='mpesa').count(),
-                'bank': payments.filter(payment_method='bank').count(),
-                'cash': payments.filter(payment_method='cash').count(),
+                'total_payments': totals['total_payments'],
+                'completed_payments': totals['completed_payments'],
+                'failed_payments': totals['failed_payments'],
+                'pending_payments': totals['pending_payments'],
+                'total_amount': totals['total_amount'] or Decimal('0'),
+                # Payment method breakdown
+                'payment_methods': {
+                    'mpesa': totals['mpesa'],
+                    'bank': totals['bank'],
+                    'cash': totals['cash'],
+                },
             }
 
             # Success rate
@@ -229,7 +306,7 @@ class PaymentAnalyticsCalculator:
             return summary
 
         except Exception as e:
-            logger.error(f"Error calculating payment summary: {e}")
+            logger.error("Error calculating payment summary: %s", e)
             return {'error': str(e)}
 
     @staticmethod
@@ -238,41 +315,39 @@ class PaymentAnalyticsCalculator:
         try:
             escrow_accounts = EscrowAccount.objects.all()
 
+            # Counts and amounts per status in one pass
+            totals = escrow_accounts.aggregate(
+                total_escrow_accounts=Count('id'),
+                active_escrow=Count('id', filter=Q(status='active')),
+                released_escrow=Count('id', filter=Q(status='released')),
+                disputed_escrow=Count('id', filter=Q(status='disputed')),
+                total_amount_in_escrow=Sum('amount', filter=Q(status='active')),
+                total_amount_released=Sum('amount', filter=Q(status='released')),
+                average_holding_time=Avg(
+                    ExpressionWrapper(F('release_date') - F('created_at'), output_field=DurationField()),
+                    filter=Q(status='released', release_date__isnull=False)
+                ),
+            )
+
             summary = {
-                'total_escrow_accounts': escrow_accounts.count(),
-                'active_escrow': escrow_accounts.filter(status='active').count(),
-                'released_escrow': escrow_accounts.filter(status='released').count(),
-                'disputed_escrow': escrow_accounts.filter(status='disputed').count(),
+                'total_escrow_accounts': totals['total_escrow_accounts'],
+                'active_escrow': totals['active_escrow'],
+                'released_escrow': totals['released_escrow'],
+                'disputed_escrow': totals['disputed_escrow'],
+                'total_amount_in_escrow': totals['total_amount_in_escrow'] or Decimal('0'),
+                'total_amount_released': totals['total_amount_released'] or Decimal('0'),
             }
 
-            # Amount calculations
-            summary['total_amount_in_escrow'] = float(escrow_accounts.filter(
-                status='active'
-            ).aggregate(total=Sum('amount'))['total'] or 0)
-
-            summary['total_amount_released'] = float(escrow_accounts.filter(
-                status='released'
-            ).aggregate(total=Sum('amount'))['total'] or 0)
-
             # Average escrow holding time
-            released_escrows = escrow_accounts.filter(
-                status='released',
-                release_date__isnull=False
+            average_holding_time = totals['average_holding_time']
+            summary['average_holding_days'] = (
+                average_holding_time.total_seconds() / 86400 if average_holding_time else 0
             )
 
-            if released_escrows.exists():
-                total_days = sum([
-                    (escrow.release_date.date() - escrow.created_at.date()).days
-                    for escrow in released_escrows
-                ])
-                summary['average_holding_days'] = total_days / released_escrows.count()
-            else:
-                summary['average_holding_days'] = 0
-
             return summary
 
         except Exception as e:
-            logger.error(f"Error calculating escrow summary: {e}")
+            logger.error("Error calculating escrow summary: %s", e)
             return {'error': str(e)}
 
     @staticmethod
@@ -284,52 +359,64 @@ class PaymentAnalyticsCalculator:
             if not end_date:
                 end_date = timezone.now().date()
 
-            completed_payments = Payment.objects.filter(
-                status__in=['completed', 'paid'],
-                created_at__date__range=[start_date, end_date]
+            # Completed days come from the nightly PaymentAnalytics rollup
+            today = timezone.localdate()
+            rows = PaymentAnalytics.objects.filter(
+                date__range=[start_date, min(end_date, today - timedelta(days=1))]
+            ).order_by('date').values(
+                'date', 'total_transactions', 'total_amount', 'total_fees_collected'
             )
 
-            total_revenue = completed_payments.aggregate(
-                total=Sum('amount')
-            )['total'] or 0
+            daily_data = [
+                {
+                    'date': row['date'].isoformat(),
+                    'transactions': row['total_transactions'],
+                    'revenue': row['total_amount'],
+                    'fees_collected': row['total_fees_collected']
+                }
+                for row in rows.iterator(chunk_size=1000)
+            ]
+            total_revenue = sum((day['revenue'] for day in daily_data), Decimal('0'))
+
+            # Today has no rollup yet, so its completed payments are summed live
+            if end_date >= today:
+                start, end = local_day_bounds(max(start_date, today), end_date)
+                total_revenue += Payment.objects.filter(
+                    status__in=['completed', 'paid'],
+                    created_at__gte=start,
+                    created_at__lt=end
+                ).aggregate(total=Sum('amount'))['total'] or Decimal('0')
 
             # Platform fee calculation (3% default)
-            platform_fee_rate = 0.03
+            platform_fee_rate = Decimal('0.03')
             platform_fees = total_revenue * platform_fee_rate
 
-            # Daily breakdown
-            analytics_data = PaymentAnalytics.objects.filter(
-                date__range=[start_date, end_date]
-            ).order_by('date')
-
-            daily_data = []
-            for analytics in analytics_data:
-                daily_data.append({
-                    'date': analytics.date.isoformat(),
-                    'transactions': analytics.total_transactions,
-                    'revenue': float(analytics.total_amount),
-                    'fees_collected': float(analytics.total_fees_collected)
-                })
-
             return {
                 'period': {
                     'start_date': start_date.isoformat(),
                     'end_date': end_date.isoformat()
                 },
-                'total_revenue': float(total_revenue),
-                'platform_fees': float(platform_fees),
-                'net_revenue': float(total_revenue - platform_fees),
+                'total_revenue': total_revenue,
+                'platform_fees': platform_fees,
+                'net_revenue': total_revenue - platform_fees,
                 'daily_breakdown': daily_data
             }
 
         except Exception as e:
-            logger.error(f"Error calculating revenue analytics: {e}")
+            logger.error("Error calculating revenue analytics: %s", e)
             return {'error': str(e)}
 
 
-def validate_payment_amount(amount: float, order_total: float) -> Dict:
+def _to_money(value) -> Decimal:
+    """Coerce ``value`` to a Decimal rounded to whole cents"""
+    return Decimal(str(value)).quantize(_CENT)
+
+
+def validate_payment_amount(amount: Decimal, order_total: Decimal) -> Dict:
     """Validate payment amount against order total"""
     try:
+        amount, order_total = _to_money(amount), _to_money(order_total)
+
         if amount <= 0:
             return {
                 'valid': False,
@@ -354,7 +441,7 @@ def validate_payment_amount(amount: float, order_total: float) -> Dict:
 def format_mpesa_phone_number(phone_number: str) -> str:
     """Format phone number for M-Pesa API"""
     # Remove any spaces or special characters
-    phone = ''.join(filter(str.isdigit, phone_number))
+    phone = phone_number.translate(_NON_DIGITS)
 
     # Handle different formats
     if phone.startswith('0'):
@@ -2,11 +2,12 @@ from rest_framework import generics, permissions, status
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from django.utils import timezone
 from django.db import transaction
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse, OpenApiExample
 from drf_spectacular.types import OpenApiTypes
+from core.mixins import AutoPrefetchViewSetMixin
 from core.utils import APIResponse
+from orders.models import OrderItem
 from .models import (
     Payment, MpesaTransaction, EscrowAccount,
     PaymentWebhook, PaymentRefund, PaymentAnalytics
@@ -16,13 +17,14 @@ from .serializers import (
     EscrowAccountSerializer, PaymentRefundSerializer, PaymentRefundCreateSerializer,
     PaymentStatusUpdateSerializer, MpesaCallbackSerializer, PaymentAnalyticsSerializer
 )
-from .services import PaymentProcessingService, MpesaService
+from .services import mpesa_service, payment_service
+from .tasks import process_mpesa_callback
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class PaymentListCreateView(generics.ListCreateAPIView):
+class PaymentListCreateView(AutoPrefetchViewSetMixin, generics.ListCreateAPIView):
     """List user's payments or create new payment"""
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
@@ -30,7 +32,7 @@ class PaymentListCreateView(generics.ListCreateAPIView):
     ordering = ['-created_at']
 
     def get_queryset(self):
-        return Payment.objects.filter(payer=self.request.user).select_related('order')
+        return Payment.objects.filter(payer=self.request.user)
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -67,20 +69,18 @@ class PaymentListCreateView(generics.ListCreateAPIView):
                 payment = serializer.save(payer=request.user)
 
                 # Initiate payment processing
-                processing_service = PaymentProcessingService()
                 phone_number = serializer.validated_data.get('phone_number')
 
-                result = processing_service.initiate_payment(payment, phone_number)
+                result = payment_service.initiate_payment(payment, phone_number)
 
                 if result['success']:
-                    # Create escrow account for seller protection
-                    if payment.order and hasattr(payment.order, 'items'):
-                        # Get first seller (could be enhanced for multi-vendor)
-                        order_items = payment.order.items.select_related('product__farmer').first()
-                        if order_items:
-                            processing_service.create_escrow_account(
-                                payment, order_items.product.farmer.id
-                            )
+                    # Create escrow account for seller protection, held for the
+                    # first item's farmer (could be enhanced for multi-vendor)
+                    farmer_id = OrderItem.objects.filter(
+                        order_id=payment.order_id
+                    ).values_list('product__farmer_id', flat=True).first()
+                    if farmer_id:
+                        payment_service.create_escrow_account(payment, farmer_id)
 
                     response_data = PaymentSerializer(payment).data
                     response_data.update(result)
@@ -95,14 +95,14 @@ class PaymentListCreateView(generics.ListCreateAPIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
-class PaymentDetailView(generics.RetrieveAPIView):
+class PaymentDetailView(AutoPrefetchViewSetMixin, generics.RetrieveAPIView):
     """Get payment details"""
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
     lookup_field = 'payment_id'
 
     def get_queryset(self):
-        return Payment.objects.filter(payer=self.request.user).select_related('order')
+        return Payment.objects.filter(payer=self.request.user)
 
     @extend_schema(
         summary="Get payment details",
@@ -124,7 +124,9 @@ class PaymentDetailView(generics.RetrieveAPIView):
 def update_payment_status(request, payment_id):
     """Update payment status (admin only)"""
     try:
-        payment = Payment.objects.get(payment_id=payment_id)
+        payment = PaymentSerializer.setup_eager_loading(
+            Payment.objects.all()
+        ).get(payment_id=payment_id)
     except Payment.DoesNotExist:
         return Response({
             'error': 'Payment not found'
@@ -159,7 +161,6 @@ def mpesa_callback(request):
     """Handle M-Pesa payment callbacks"""
     try:
         # Validate IP address
-        mpesa_service = MpesaService()
         client_ip = request.META.get('REMOTE_ADDR', '')
 
         if not mpesa_service.validate_callback_ip(client_ip):
@@ -169,65 +170,29 @@ def mpesa_callback(request):
                 'ResultDesc': 'Invalid source IP'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        # Store webhook data
-        webhook = PaymentWebhook.objects.create(
-            webhook_type='mpesa_callback',
-            raw_data=request.data,
-            source_ip=client_ip,
-            user_agent=request.META.get('HTTP_USER_AGENT', '')
-        )
-
-        # Process callback
-        processed_data = mpesa_service.process_callback(request.data)
-
-        if 'checkout_request_id' in processed_data:
-            try:
-                # Find the corresponding M-Pesa transaction
-                mpesa_transaction = MpesaTransaction.objects.get(
-                    checkout_request_id=processed_data['checkout_request_id']
-                )
-
-                # Update transaction with callback data
-                mpesa_transaction.result_code = processed_data.get('result_code')
-                mpesa_transaction.result_desc = processed_data.get('result_desc')
-
-                if processed_data['success']:
-                    metadata = processed_data.get('metadata', {})
-                    mpesa_transaction.mpesa_receipt_number = metadata.get('mpesa_receipt_number')
-                    mpesa_transaction.transaction_date = metadata.get('transaction_date')
-                    mpesa_transaction.save()
-
-                    # Update payment status
-                    payment = mpesa_transaction.payment
-                    payment.status = 'completed'
-                    payment.payment_date = timezone.now()
-                    payment.external_transaction_id = metadata.get('mpesa_receipt_number')
-                    payment.save()
-
-                    # Update order payment status
-                    if payment.order:
-                        payment.order.payment_status = 'paid'
-                        payment.order.save()
-
-                    webhook.payment = payment
-                    webhook.processed = True
-                    webhook.save()
-
-                else:
-                    # Payment failed
-                    mpesa_transaction.save()
-                    payment = mpesa_transaction.payment
-                    payment.status = 'failed'
-                    payment.failure_reason = processed_data.get('result_desc')
-                    payment.save()
-
-                    webhook.payment = payment
-                    webhook.processed = True
-                    webhook.save()
+        # Store webhook data, collapsing Daraja redeliveries of one callback
+        webhook_fields = {
+            'webhook_type': 'mpesa_callback',
+            'raw_data': request.data,
+            'source_ip': client_ip,
+            'user_agent': request.META.get('HTTP_USER_AGENT', '')
+        }
+        dedup_key = PaymentWebhook.dedup_key_for(request.data)
+        if dedup_key:
+            webhook, created = PaymentWebhook.objects.get_or_create(
+                dedup_key=dedup_key, defaults=webhook_fields
+            )
+            if not created and webhook.processed:
+                return Response({
+                    'ResultCode': 0,
+                    'ResultDesc': 'Accepted'
+                })
+        else:
+            webhook = PaymentWebhook.objects.create(**webhook_fields)
 
-            except MpesaTransaction.DoesNotExist:
-                webhook.processing_error = f"M-Pesa transaction not found for checkout request: {processed_data.get('checkout_request_id')}"
-                webhook.save()
+        # Acknowledge Daraja now; lookups and status updates run on a worker
+        webhook_id = str(webhook.id)
+        transaction.on_commit(lambda: process_mpesa_callback.delay(webhook_id))
 
         return Response({
             'ResultCode': 0,
@@ -255,7 +220,6 @@ def query_mpesa_payment(request, payment_id):
         payment = Payment.objects.get(payment_id=payment_id, payer=request.user)
         mpesa_transaction = payment.mpesa_transaction
 
-        mpesa_service = MpesaService()
         result = mpesa_service.query_stk_status(mpesa_transaction.checkout_request_id)
 
         if result['success']:
@@ -263,7 +227,7 @@ def query_mpesa_payment(request, payment_id):
             data = result['data']
             mpesa_transaction.result_code = data.get('ResultCode')
             mpesa_transaction.result_desc = data.get('ResultDesc')
-            mpesa_transaction.save()
+            mpesa_transaction.save(update_fields=['result_code', 'result_desc', 'updated_at'])
 
             return Response(MpesaTransactionSerializer(mpesa_transaction).data)
         else:
@@ -281,7 +245,7 @@ def query_mpesa_payment(request, payment_id):
         }, status=status.HTTP_404_NOT_FOUND)
 
 
-class PaymentRefundListCreateView(generics.ListCreateAPIView):
+class PaymentRefundListCreateView(AutoPrefetchViewSetMixin, generics.ListCreateAPIView):
     """List user's refund requests or create new refund"""
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend]
@@ -289,9 +253,7 @@ class PaymentRefundListCreateView(generics.ListCreateAPIView):
     ordering = ['-created_at']
 
     def get_queryset(self):
-        return PaymentRefund.objects.filter(
-            payment__payer=self.request.user
-        ).select_related('payment')
+        return PaymentRefund.objects.filter(payment__payer=self.request.user)
 
     def get_serializer_class(self):
         if self.request.method == 'POST':
@@ -333,8 +295,7 @@ def release_escrow_funds(request, escrow_id):
                 'error': 'Permission denied'
             }, status=status.HTTP_403_FORBIDDEN)
 
-        processing_service = PaymentProcessingService()
-        result = processing_service.release_escrow_funds(
+        result = payment_service.release_escrow_funds(
             str(escrow_id),
             release_reason='Released by buyer'
         )
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-16 12:00
+
+from django.db import migrations, models
+
+
+def delete_duplicate_analytics(apps, schema_editor):
+    """Keep only the most recently updated analytics row for each product"""
+    ProductAnalytics = apps.get_model("products", "ProductAnalytics")
+    latest = ProductAnalytics.objects.filter(
+        product=models.OuterRef("product")
+    ).order_by("-updated_at", "-created_at").values("pk")[:1]
+    ProductAnalytics.objects.exclude(pk=models.Subquery(latest)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("products", "0002_initial"),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_analytics, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="productanalytics",
+            constraint=models.UniqueConstraint(
+                fields=("product",), name="unique_product_analytics"
+            ),
+        ),
+    ]
@@ -153,5 +153,10 @@ class ProductAnalytics(BaseModel):
     last_viewed = models.DateTimeField(null=True, blank=True)
     last_ordered = models.DateTimeField(null=True, blank=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product'], name='unique_product_analytics'),
+        ]
+
     def __str__(self):
         return f"Analytics for {self.product.name}"
@@ -2,13 +2,16 @@
 Comprehensive API endpoint tests for AgriConnect
 """
 import json
-from django.test import TestCase
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.contrib.auth import get_user_model
-from products.models import ProductCategory, Product
-from orders.models import Cart, CartItem, Order
+from products.models import ProductCategory, Product, ProductAnalytics
+from orders.models import Cart, CartItem, Order, OrderItem, OrderTracking
+from orders.tasks import record_tracking
 
 User = get_user_model()
 
@@ -203,11 +206,13 @@ class ProductAPITests(APITestCase):
         self.assertEqual(len(response.data['results']), 1)
 
 
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
 class OrderAPITests(APITestCase):
     """Test order and cart endpoints"""
 
     def setUp(self):
         self.client = APIClient()
+        cache.clear()
 
         # Create test users
         self.farmer = User.objects.create_user(
@@ -268,6 +273,51 @@ class OrderAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(response.data['success'])
 
+    def test_add_to_cart_existing_item(self):
+        """Test adding an item already in the cart increases its quantity"""
+        self.client.force_authenticate(user=self.buyer)
+
+        data = {
+            'product_id': str(self.product.id),
+            'quantity': 10.0
+        }
+
+        self.client.post(self.add_to_cart_url, data, format='json')
+        response = self.client.post(self.add_to_cart_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(float(response.data['data']['quantity']), 20.0)
+        self.assertEqual(float(response.data['data']['total_price']), 3000.0)
+
+    def test_view_cart_reflects_added_item(self):
+        """Test the cached cart is refreshed after adding an item"""
+        self.client.force_authenticate(user=self.buyer)
+
+        response = self.client.get(self.cart_url)
+        self.assertEqual(len(response.data['items']), 0)
+
+        self.client.post(self.add_to_cart_url, {
+            'product_id': str(self.product.id),
+            'quantity': 10.0
+        }, format='json')
+
+        response = self.client.get(self.cart_url)
+        self.assertEqual(len(response.data['items']), 1)
+
+    def test_clear_cart(self):
+        """Test clearing the cart empties it and drops the cached copy"""
+        self.client.force_authenticate(user=self.buyer)
+        self.client.post(self.add_to_cart_url, {
+            'product_id': str(self.product.id),
+            'quantity': 10.0
+        }, format='json')
+        self.client.get(self.cart_url)
+
+        response = self.client.delete(reverse('clear-cart'))
+
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        response = self.client.get(self.cart_url)
+        self.assertEqual(len(response.data['items']), 0)
+
     def test_create_order(self):
         """Test creating an order from cart items"""
         self.client.force_authenticate(user=self.buyer)
@@ -290,6 +340,92 @@ class OrderAPITests(APITestCase):
         self.assertTrue(response.data['success'])
         self.assertEqual(response.data['data']['status'], 'pending')
 
+    def test_create_order_clears_cart(self):
+        """Test the cart is empty after ordering and can be refilled"""
+        self.client.force_authenticate(user=self.buyer)
+        cart_item = {'product_id': str(self.product.id), 'quantity': 10.0}
+
+        self.client.post(self.add_to_cart_url, cart_item, format='json')
+        self.client.post(self.create_order_url, {
+            'delivery_address': '123 Test Street',
+            'delivery_county': 'Kisii',
+            'delivery_phone': '+254712345679',
+            'cart_items': [cart_item]
+        }, format='json')
+
+        response = self.client.get(self.cart_url)
+        self.assertEqual(len(response.data['items']), 0)
+
+        self.client.post(self.add_to_cart_url, cart_item, format='json')
+        response = self.client.get(self.cart_url)
+        self.assertEqual(len(response.data['items']), 1)
+        self.assertEqual(float(response.data['items'][0]['quantity']), 10.0)
+
+    def test_create_order_updates_product_analytics(self):
+        """Test each order increments the product's order count"""
+        self.client.force_authenticate(user=self.buyer)
+
+        data = {
+            'delivery_address': '123 Test Street',
+            'delivery_county': 'Kisii',
+            'delivery_phone': '+254712345679',
+            'cart_items': [
+                {'product_id': str(self.product.id), 'quantity': 10.0}
+            ]
+        }
+
+        self.client.post(self.create_order_url, data, format='json')
+        self.client.post(self.create_order_url, data, format='json')
+
+        analytics = ProductAnalytics.objects.get(product=self.product)
+        self.assertEqual(analytics.orders_count, 2)
+        self.assertIsNotNone(analytics.last_ordered)
+
+    def test_create_order_queues_tracking(self):
+        """Test the initial tracking entry is dispatched after commit"""
+        self.client.force_authenticate(user=self.buyer)
+
+        data = {
+            'delivery_address': '123 Test Street',
+            'delivery_county': 'Kisii',
+            'delivery_phone': '+254712345679',
+            'cart_items': [
+                {'product_id': str(self.product.id), 'quantity': 10.0}
+            ]
+        }
+
+        with patch('orders.tasks.record_tracking.delay') as mock_delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(self.create_order_url, data, format='json')
+
+        order_id = response.data['data']['id']
+        mock_delay.assert_called_once_with(
+            order_id, 'order_placed', 'Order has been placed successfully',
+            self.buyer.pk, None, None, None
+        )
+
+        record_tracking(*mock_delay.call_args.args)
+        self.assertTrue(OrderTracking.objects.filter(order_id=order_id).exists())
+
+    def test_create_order_exceeding_stock(self):
+        """Test ordering more than the available stock is rejected"""
+        self.client.force_authenticate(user=self.buyer)
+
+        data = {
+            'delivery_address': '123 Test Street',
+            'delivery_county': 'Kisii',
+            'delivery_phone': '+254712345679',
+            'cart_items': [
+                {'product_id': str(self.product.id), 'quantity': 150.0}
+            ]
+        }
+
+        response = self.client.post(self.create_order_url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_available, 100)
+        self.assertFalse(Order.objects.exists())
+
     def test_list_orders(self):
         """Test listing user orders"""
         self.client.force_authenticate(user=self.buyer)
@@ -306,6 +442,59 @@ class OrderAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data['results']), 1)
 
+    def test_order_detail(self):
+        """Test retrieving an order with its items"""
+        order = Order.objects.create(
+            buyer=self.buyer,
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345679'
+        )
+        OrderItem.objects.create(order=order, product=self.product, quantity=5, unit_price=150)
+
+        self.client.force_authenticate(user=self.buyer)
+        response = self.client.get(reverse('order-detail', args=[order.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['items']), 1)
+        self.assertEqual(response.data['items'][0]['farmer_name'], self.farmer.full_name)
+        self.assertEqual(response.data['farmers'][0]['name'], self.farmer.full_name)
+
+    def test_list_orders_as_farmer_counts_all_items(self):
+        """Test farmer order list reports every item in the order"""
+        other_farmer = User.objects.create_user(
+            email='farmer2@test.com',
+            username='farmer2',
+            password='TestPass123!',
+            role='farmer',
+            first_name='Other',
+            last_name='Farmer',
+            phone_number='+254712345670'
+        )
+        other_product = Product.objects.create(
+            farmer=other_farmer,
+            category=self.category,
+            name='Test Avocados',
+            description='Fresh avocados',
+            price_per_unit=50.00,
+            quantity_available=100.00,
+            county='Kisii'
+        )
+        order = Order.objects.create(
+            buyer=self.buyer,
+            delivery_address='Test Address',
+            delivery_county='Kisii',
+            delivery_phone='+254712345679'
+        )
+        OrderItem.objects.create(order=order, product=self.product, quantity=5, unit_price=150)
+        OrderItem.objects.create(order=order, product=other_product, quantity=5, unit_price=50)
+
+        self.client.force_authenticate(user=self.farmer)
+        response = self.client.get(self.orders_url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(response.data['results'][0]['items_count'], 2)
+        self.assertEqual(len(response.data['results'][0]['farmers']), 2)
+
 
 class APIDocumentationTests(TestCase):
     """Test API documentation endpoints"""